@@ -0,0 +1,124 @@
+"""SciTran Reaper upload checkpoints for resumable bulk imports"""
+
+import os
+import json
+import logging
+import datetime
+import threading
+import multiprocessing.pool
+
+log = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+
+    """
+    Persistent record of finished and failed upload tasks, keyed by file path or DICOM UID.
+
+    Results are appended to the checkpoint file as JSON lines as soon as a task finishes, so a crashed import can be
+    resumed without redoing successful work. The last recorded result for a key wins.
+    """
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.results = {}
+        self.lock = threading.Lock()
+        self.checkpoint_fd = None
+        if path is None:
+            return
+        cut_off = False
+        if resume and os.path.exists(path):
+            with open(path, 'r') as fd:
+                for line in fd:
+                    cut_off = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        log.debug('Skipping corrupt checkpoint record')
+                        continue
+                    self.results[record['key']] = record['success']
+            log.warning('Resuming from checkpoint: %d done, %d failed', self.done_cnt, len(self.results) - self.done_cnt)
+        self.checkpoint_fd = open(path, 'a' if resume else 'w')
+        if cut_off:  # end the record a crash interrupted, so that the next one starts on a line of its own
+            self.checkpoint_fd.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+    @property
+    def done_cnt(self):
+        # pylint: disable=missing-docstring
+        return sum(1 for success in self.results.itervalues() if success)
+
+    def is_done(self, key):
+        """Return True if the task identified by key finished successfully before."""
+        return self.results.get(key, False)
+
+    def record(self, key, success):
+        """Record the result of a task and persist it immediately."""
+        with self.lock:
+            self.results[key] = bool(success)
+            if self.checkpoint_fd is not None:
+                record = {'key': key, 'success': bool(success), 'timestamp': datetime.datetime.utcnow().isoformat()}
+                self.checkpoint_fd.write(json.dumps(record) + '\n')
+                self.checkpoint_fd.flush()
+
+    def close(self):
+        # pylint: disable=missing-docstring
+        if self.checkpoint_fd is not None:
+            self.checkpoint_fd.close()
+            self.checkpoint_fd = None
+
+
+def run_tasks(tasks, checkpoint=None, jobs=1):
+    """
+    Run upload tasks, skipping those already finished according to the checkpoint.
+
+    Parameters
+    ----------
+    tasks : list
+        (key, func) tuples, where func takes no arguments and returns True on success
+    checkpoint : Checkpoint
+        checkpoint to consult and update; a transient one is used if None
+    jobs : int
+        number of concurrent tasks
+
+    Returns
+    -------
+    success_cnt : int
+        number of tasks finished successfully, including those skipped
+    failure_cnt : int
+        number of failed tasks
+
+    """
+    checkpoint = checkpoint or Checkpoint()
+    pending = [(key, func) for key, func in tasks if not checkpoint.is_done(key)]
+    if len(pending) < len(tasks):
+        log.warning('Skipping %d of %d tasks finished previously', len(tasks) - len(pending), len(tasks))
+
+    def run_task(task):
+        # pylint: disable=missing-docstring
+        key, func = task
+        try:
+            success = func()
+        # pylint: disable=broad-except
+        except Exception as ex:
+            log.error('Error        %s: %s', key, ex)
+            success = False
+        checkpoint.record(key, success)
+        return bool(success)
+
+    if jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(jobs)
+        try:
+            results = pool.map(run_task, pending, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_task(task) for task in pending]
+    failure_cnt = results.count(False)
+    return len(tasks) - failure_cnt, failure_cnt
@@ -0,0 +1,258 @@
+"""SciTran Reaper parallel directory crawler and file manifest"""
+
+import os
+import json
+import Queue
+import logging
+import threading
+import multiprocessing
+
+from . import dcm
+
+log = logging.getLogger(__name__)
+
+WALK_THREADS = 8
+PARSE_CHUNKSIZE = 64
+
+
+def walk(path, symlinks=False, threads=WALK_THREADS):
+    """
+    Walk a directory tree with a pool of listing threads.
+
+    Dotfiles and dot-directories are skipped. Symlinked directories are listed in dirnames, but only descended into
+    if symlinks is True, matching os.walk().
+
+    Parameters
+    ----------
+    path : str
+        top-level directory
+    symlinks : bool
+        follow symbolic links that resolve to directories
+    threads : int
+        number of concurrent directory listings
+
+    Returns
+    -------
+    tree : list
+        (dirpath, dirnames, files) tuples in top-down order, where files is a list of (filename, size, mtime) tuples
+
+    """
+    tree = []
+    tree_lock = threading.Lock()
+    dir_queue = Queue.Queue()
+
+    def list_dir(dirpath):
+        # pylint: disable=missing-docstring
+        try:
+            names = sorted(fn for fn in os.listdir(dirpath) if not fn.startswith('.'))
+        except OSError as ex:
+            log.warning('Cannot list %s: %s', dirpath, ex)
+            names = []
+        dirnames, files = [], []
+        for name in names:
+            fp = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(fp)
+            except OSError:
+                try:
+                    stat = os.lstat(fp)
+                except OSError as ex:  # removed since listing
+                    log.warning('Cannot stat %s: %s', fp, ex)
+                    continue
+            if os.path.isdir(fp):
+                dirnames.append(name)
+                if symlinks or not os.path.islink(fp):
+                    dir_queue.put(fp)
+            else:
+                files.append((name, stat.st_size, stat.st_mtime))
+        with tree_lock:
+            tree.append((dirpath, dirnames, files))
+
+    def worker():
+        # pylint: disable=missing-docstring
+        while True:
+            dirpath = dir_queue.get()
+            if dirpath is None:
+                break
+            try:
+                list_dir(dirpath)
+            finally:
+                dir_queue.task_done()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    dir_queue.put(path)
+    dir_queue.join()
+    for _ in workers:
+        dir_queue.put(None)
+    for thread in workers:
+        thread.join()
+    tree.sort(key=lambda entry: os.path.relpath(entry[0], path).split(os.sep))
+    return tree
+
+
+class Manifest(object):
+
+    """
+    Persistent record of crawled files and their parsed DICOM headers.
+
+    Entries are appended to the manifest file as JSON lines as soon as they are parsed, so an interrupted crawl
+    loses at most the entry being written. Entries are reused as long as size and mtime of the file are unchanged.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.manifest_fd = None
+        if path is None:
+            return
+        cut_off = False
+        if os.path.exists(path):
+            with open(path, 'r') as fd:
+                for line in fd:
+                    cut_off = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        log.debug('Skipping corrupt manifest entry')
+                        continue
+                    self.entries[entry['path']] = entry
+            log.warning('Loaded %d entries from manifest %s', len(self.entries), path)
+        self.manifest_fd = open(path, 'a')
+        if cut_off:  # end the entry a crash interrupted, so that the next one starts on a line of its own
+            self.manifest_fd.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+    def lookup(self, filepath, size, mtime, tag_names=()):
+        """Return the manifest entry for filepath, or None if missing, outdated or lacking any of tag_names."""
+        entry = self.entries.get(filepath)
+        if entry is None or entry['size'] != size or entry['mtime'] != mtime:
+            return None
+        if entry['dicom'] and not set(tag_names).issubset(entry['tags']):
+            return None
+        return entry
+
+    def record(self, entry):
+        """Add an entry and persist it immediately."""
+        self.entries[entry['path']] = entry
+        if self.manifest_fd is not None:
+            try:
+                line = json.dumps(entry)
+            except (TypeError, ValueError) as ex:
+                log.warning('Cannot record %s in manifest: %s', entry['path'], ex)
+                return
+            self.manifest_fd.write(line + '\n')
+            self.manifest_fd.flush()
+
+    def close(self):
+        # pylint: disable=missing-docstring
+        if self.manifest_fd is not None:
+            self.manifest_fd.close()
+            self.manifest_fd = None
+
+
+def parse_dicom_header(args):
+    """
+    Parse the DICOM header of a single file into a manifest entry.
+
+    Runs in a worker process; args is a (filepath, size, mtime, tag_names) tuple. Files that cannot be parsed are
+    logged and returned as non-DICOM entries, so one bad file doesn't abort the crawl.
+    """
+    filepath, size, mtime, tag_names = args
+    entry = {'path': filepath, 'size': size, 'mtime': mtime, 'dicom': False, 'uids': None, 'tags': {}, 'image_type': None}
+    try:
+        dcm_file = dcm.DicomFile(filepath)
+    except dcm.DicomFileError:
+        return entry
+    except Exception as ex:  # pylint: disable=broad-except
+        log.warning('Cannot parse %s: %s', filepath, ex)
+        return entry
+    try:
+        parsed = dict(entry, dicom=True)
+        try:
+            related_series = dcm_file.raw.get('RelatedSeriesSequence') or [{}]
+            parsed['uids'] = {
+                'study': dcm_file.raw.StudyInstanceUID,
+                'series': dcm_file.raw.SeriesInstanceUID,
+                'primary_series': related_series[0].get('SeriesInstanceUID'),
+                'image': dcm_file.raw.SOPInstanceUID,
+            }
+        except AttributeError:
+            pass
+        image_type = dcm_file.raw.get('ImageType')
+        parsed['image_type'] = image_type if image_type is None or isinstance(image_type, basestring) else list(image_type)
+        parsed['tags'] = {tag_name: decode_text(dcm_file.get_tag(tag_name)) for tag_name in tag_names}
+    except Exception as ex:  # pylint: disable=broad-except
+        log.warning('Cannot parse %s: %s', filepath, ex)
+        return entry
+    return parsed
+
+
+def decode_text(value):
+    """
+    Decode a tag value as UTF-8, falling back to Latin-1, so that it can be JSON-encoded.
+
+    Manifest entries loaded from disk hold unicode anyway; undecodable header bytes are common in names and
+    descriptions.
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def crawl_dicom(path, tag_names=(), symlinks=False, manifest=None, processes=None):
+    """
+    Crawl a directory tree and return manifest entries for all files, parsing DICOM headers in parallel.
+
+    Files already present in the manifest with unchanged size and mtime are not parsed again.
+
+    Parameters
+    ----------
+    path : str
+        top-level directory
+    tag_names : iterable
+        DICOM tags to extract from every file, in addition to the UIDs
+    symlinks : bool
+        follow symbolic links that resolve to directories
+    manifest : Manifest
+        manifest to consult and update; a transient one is used if None
+    processes : int
+        number of header parsing processes [CPU count]
+
+    Returns
+    -------
+    entries : list
+        manifest entries in directory order
+
+    """
+    manifest = manifest or Manifest()
+    tag_names = sorted(set(tag_name for tag_name in tag_names if tag_name))
+    filepaths, pending = [], []
+    for dirpath, _, files in walk(path, symlinks):
+        log.info('  %s', os.path.relpath(dirpath, path))
+        for filename, size, mtime in files:
+            fp = os.path.join(dirpath, filename)
+            filepaths.append(fp)
+            if manifest.lookup(fp, size, mtime, tag_names) is None:
+                pending.append((fp, size, mtime, tag_names))
+    log.warning('Parsing %d of %d files (%d unchanged)', len(pending), len(filepaths), len(filepaths) - len(pending))
+    if pending:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for entry in pool.imap_unordered(parse_dicom_header, pending, PARSE_CHUNKSIZE):
+                manifest.record(entry)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return [manifest.entries[fp] for fp in filepaths]
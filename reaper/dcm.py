@@ -3,48 +3,82 @@
 import os
 import shutil
 import logging
+import zipfile
 import datetime
 
-import dicom
-
 from . import util
+from . import trace
+
+dicom = util.LazyModule('dicom')  # pylint: disable=invalid-name
 
 log = logging.getLogger(__name__)
 
 FILETYPE = 'dicom'
 GEMS_TYPE_SCREENSHOT = ['DERIVED', 'SECONDARY', 'SCREEN SAVE']
 GEMS_TYPE_VXTL = ['DERIVED', 'SECONDARY', 'VXTL STATE']
+EPOCH = datetime.datetime(1970, 1, 1)
+
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+DEFLATED_TRANSFER_SYNTAX = '1.2.840.10008.1.2.1.99'
+RLE_TRANSFER_SYNTAX = '1.2.840.10008.1.2.5'
+ENCAPSULATED_TRANSFER_SYNTAX_PREFIX = '1.2.840.10008.1.2.4.'  # JPEG, JPEG-LS, JPEG 2000, MPEG
+
 
+def is_compressed_syntax(transfer_syntax):
+    """Return True if instances in transfer_syntax are already compressed, so deflating them again gains little."""
+    return bool(transfer_syntax) and (transfer_syntax.startswith(ENCAPSULATED_TRANSFER_SYNTAX_PREFIX) or
+                                      transfer_syntax in (DEFLATED_TRANSFER_SYNTAX, RLE_TRANSFER_SYNTAX))
+
+
+def instance_uids(path):
+    """Return the SOPInstanceUIDs of the DICOM files in path, reading only their file meta information."""
+    uids = set()
+    for filename in os.listdir(path):
+        try:
+            uids.add(dicom.filereader.read_file_meta_info(os.path.join(path, filename)).MediaStorageSOPInstanceUID)
+        except (dicom.errors.InvalidDicomError, AttributeError, IOError):
+            log.warning('Unreadable   file meta information of %s', filename)
+    return uids
 
-def pkg_series(_id, path, map_key, opt_key=None, de_identify=False, timezone=None):
-    # pylint: disable=missing-docstring
+
+def pkg_series(_id, path, map_key, opt_key=None, de_identify=False, timezone=None, name_suffix=''):
+    # pylint: disable=missing-docstring,too-many-arguments,too-many-locals
     dcm_dict = {}
     start = datetime.datetime.utcnow()
     filepaths = [os.path.join(path, filename) for filename in os.listdir(path)]
     file_cnt = len(filepaths)
-    for filepath in filepaths:
-        dcm = DicomFile(filepath, map_key, opt_key)
-        dcm_dict.setdefault(dcm.acq_no, []).append(filepath)
+    with trace.span('inspect', files=file_cnt):
+        for filepath in filepaths:
+            dcm = DicomFile(filepath, map_key, opt_key)
+            dcm_dict.setdefault(dcm.acq_no, []).append(filepath)
     duration = (datetime.datetime.utcnow() - start).total_seconds()
     log.info('Inspected    %s, %d images in %.1fs [%.0f/s]', _id, file_cnt, duration, file_cnt / duration)
     metadata_map = {}
     start = datetime.datetime.utcnow()
     for acq_no, acq_paths in dcm_dict.iteritems():
-        name_prefix = _id + ('_' + acq_no if acq_no is not None else '')
+        name_prefix = _id + ('_' + acq_no if acq_no is not None else '') + name_suffix
         dir_name = name_prefix + '.' + FILETYPE
         arcdir_path = os.path.join(path, '..', dir_name)
         os.mkdir(arcdir_path)
-        for filepath in acq_paths:
-            dcm = DicomFile(filepath, map_key, opt_key, parse=True, de_identify=de_identify, timezone=timezone)
-            filename = os.path.basename(filepath)
-            if filename.startswith('(none)'):
-                filename = filename.replace('(none)', 'NA')
-            file_time = max(int(dcm.acquisition_timestamp.strftime('%s')), 315561600)  # zip can't handle < 1980
-            os.utime(filepath, (file_time, file_time))  # correct timestamps
-            os.rename(filepath, '%s.dcm' % os.path.join(arcdir_path, filename))
-        arc_path = util.create_archive(arcdir_path, dir_name)
-        metadata = util.object_metadata(dcm, timezone, os.path.basename(arc_path))
-        util.set_archive_metadata(arc_path, metadata)
+        stored = set()
+        with trace.span('parse', files=len(acq_paths)):
+            for filepath in acq_paths:
+                dcm = DicomFile(filepath, map_key, opt_key, parse=True, de_identify=de_identify, timezone=timezone)
+                filename = os.path.basename(filepath)
+                if filename.startswith('(none)'):
+                    filename = filename.replace('(none)', 'NA')
+                file_time = max(int(dcm.acquisition_timestamp.strftime('%s')), 315561600)  # zip can't handle < 1980
+                os.utime(filepath, (file_time, file_time))  # correct timestamps
+                arcfile_path = '%s.dcm' % os.path.join(arcdir_path, filename)
+                os.rename(filepath, arcfile_path)
+                if is_compressed_syntax(dcm.transfer_syntax):
+                    stored.add(arcfile_path)
+        with trace.span('archive', files=len(acq_paths)) as span:
+            arc_path = util.create_archive(arcdir_path, dir_name, stored=stored)
+        span['bytes'] = os.path.getsize(arc_path)
+        with trace.span('metadata'):
+            metadata = util.object_metadata(dcm, timezone, os.path.basename(arc_path))
+            util.set_archive_metadata(arc_path, metadata)
         shutil.rmtree(arcdir_path)
         metadata_map[arc_path] = metadata
     duration = (datetime.datetime.utcnow() - start).total_seconds()
@@ -54,7 +88,121 @@ def pkg_series(_id, path, map_key, opt_key=None, de_identify=False, timezone=Non
     return metadata_map
 
 
-class DicomFileError(dicom.errors.InvalidDicomError):
+class SeriesPackager(object):
+
+    """
+    Incremental counterpart of pkg_series.
+
+    Files are parsed and appended to per-acquisition archives as they land in the receive directory, so packaging
+    overlaps with the transfer and the archives are ready shortly after the last image arrives. Use watch() in a
+    background thread while the transfer runs, then finish() to get the same metadata_map as pkg_series.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, _id, path, map_key, opt_key=None, de_identify=False, timezone=None, settle_time=1.0):
+        self._id = _id
+        self.path = path
+        self.map_key = map_key
+        self.opt_key = opt_key
+        self.de_identify = de_identify
+        self.timezone = timezone
+        self.settle_time = settle_time
+        self.archives = {}
+        self.seen = set()
+        self.file_cnt = 0
+        self.opt = None
+        self.discarded = False
+        self.error = None
+        self.start = datetime.datetime.utcnow()
+
+    def watch(self, done, accept=None, interval=0.2):
+        """
+        Package files as they appear until the done event is set and all remaining files are packaged.
+
+        Files modified less than settle_time seconds ago are left alone until done is set, since they may still be
+        written to. If accept is given, it is called with the opt value of the first file; packaging stops for good
+        if it returns False.
+        """
+        try:
+            while not self.discarded:
+                finished = done.is_set()
+                for filepath in self.__new_files(finished):
+                    self.add(filepath)
+                    if self.file_cnt == 1 and accept is not None and not accept(self.opt):
+                        self.discarded = True
+                        break
+                if finished:
+                    break
+                done.wait(interval)
+        # pylint: disable=broad-except
+        except Exception as ex:
+            self.error = ex
+            log.error('Error        %s: %s', self._id, ex)
+
+    def __new_files(self, finished):
+        # pylint: disable=missing-docstring
+        now = (datetime.datetime.utcnow() - EPOCH).total_seconds()
+        filepaths = []
+        for filename in os.listdir(self.path):
+            filepath = os.path.join(self.path, filename)
+            if filepath in self.seen:
+                continue
+            if not finished and now - os.path.getmtime(filepath) < self.settle_time:
+                continue
+            filepaths.append(filepath)
+        return filepaths
+
+    def add(self, filepath):
+        """Parse one file and append it to the archive of its acquisition."""
+        self.seen.add(filepath)
+        dcm = DicomFile(filepath, self.map_key, self.opt_key, parse=True, de_identify=self.de_identify, timezone=self.timezone)
+        if not self.file_cnt:
+            self.opt = dcm.opt
+        self.file_cnt += 1
+        archive = self.archives.get(dcm.acq_no)
+        if archive is None:
+            name_prefix = self._id + ('_' + dcm.acq_no if dcm.acq_no is not None else '')
+            dir_name = name_prefix + '.' + FILETYPE
+            arc_path = os.path.join(self.path, '..', dir_name) + '.zip'
+            zf = zipfile.ZipFile(arc_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            archive = self.archives[dcm.acq_no] = [zf, dir_name, None]
+        archive[2] = dcm  # metadata is taken from the last file, as in pkg_series
+        zf, dir_name = archive[0], archive[1]
+        filename = os.path.basename(filepath)
+        if filename.startswith('(none)'):
+            filename = filename.replace('(none)', 'NA')
+        file_time = max(int(dcm.acquisition_timestamp.strftime('%s')), 315561600)  # zip can't handle < 1980
+        os.utime(filepath, (file_time, file_time))  # correct timestamps
+        compress_type = zipfile.ZIP_STORED if is_compressed_syntax(dcm.transfer_syntax) else zipfile.ZIP_DEFLATED
+        zf.write(filepath, os.path.join(dir_name, filename + '.dcm'), compress_type)
+
+    def finish(self):
+        """Close all archives, set their metadata and return the metadata_map."""
+        if self.error is not None:
+            raise self.error  # pylint: disable=raising-bad-type
+        metadata_map = {}
+        for zf, _, dcm in self.archives.itervalues():
+            zf.close()
+            arc_path = os.path.normpath(zf.filename)
+            metadata = util.object_metadata(dcm, self.timezone, os.path.basename(arc_path))
+            util.set_archive_metadata(arc_path, metadata)
+            metadata_map[arc_path] = metadata
+        duration = (datetime.datetime.utcnow() - self.start).total_seconds()
+        if self.de_identify:
+            log.info('De-id\'ed     %s, %d images', self._id, self.file_cnt)
+        log.info('Compressed   %s, %d images in %.1fs [%.0f/s] while receiving', self._id, self.file_cnt, duration, self.file_cnt / duration)
+        return metadata_map
+
+    def abort(self):
+        """Close and remove all archives."""
+        for zf, _, _ in self.archives.itervalues():
+            zf.close()
+            os.remove(zf.filename)
+        self.archives = {}
+
+
+class DicomFileError(Exception):
     """DicomFileError class"""
     pass
 
@@ -67,7 +215,7 @@ class DicomFile(object):
 
     # pylint: disable=too-few-public-methods
 
-    def __init__(self, filepath, map_key=None, opt_key=None, parse=False, de_identify=False, timezone=None):
+    def __init__(self, filepath, map_key=None, opt_key=None, parse=False, de_identify=False, timezone=None, output_path=None):
         try:
             self.raw = dcm = dicom.read_file(filepath, stop_before_pixels=(not de_identify))
         except dicom.errors.InvalidDicomError:
@@ -75,6 +223,7 @@ class DicomFile(object):
 
         self._id = dcm.get(map_key, '') if map_key else None
         self.opt = dcm.get(opt_key, '') if opt_key else None
+        self.transfer_syntax = getattr(dcm, 'file_meta', {}).get('TransferSyntaxUID')
         self.acq_no = (str(dcm.get('AcquisitionNumber', '')) or None) if dcm.get('Manufacturer', '').upper() != 'SIEMENS' else None
 
         if parse or de_identify:
@@ -105,7 +254,9 @@ class DicomFile(object):
             del dcm.PatientBirthDate
             del dcm.PatientName
             del dcm.PatientID
-            dcm.save_as(filepath)
+            if self.transfer_syntax == DEFLATED_TRANSFER_SYNTAX:  # pydicom reads, but does not write, deflated data sets
+                dcm.file_meta.TransferSyntaxUID = self.transfer_syntax = EXPLICIT_VR_LITTLE_ENDIAN
+            dcm.save_as(output_path or filepath)
 
     def get_tag(self, tag_name, default=None):
         # pylint: disable=missing-docstring
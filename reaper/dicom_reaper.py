@@ -1,28 +1,159 @@
 """ SciTran DICOM Net Reaper """
 
 import os
+import re
+import shutil
 import logging
 import datetime
+import tempfile
+import threading
+import collections
 
 from . import dcm
+from . import scp
 from . import scu
+from . import util
+from . import trace
 from . import reaper
+from . import instances
+from . import packaging
 
 log = logging.getLogger('reaper.dicom')
 
+IMAGE_SIZE_ESTIMATE = 1024 * 1024  # generous for MR and CT images, received and packaged copies of a series coexist
+STUDY_BATCH_FRACTION = 0.75  # share of the images of a study that must be ready to move it with one study-level C-MOVE
+MOVE_UIDS_PER_QUERY = 64  # SOPInstanceUIDs listed in one image-level C-MOVE of a delta reap
+
+# Series-level attributes that hold the total number of images of a completed series, by manufacturer prefix.
+# A series is complete once NumberOfSeriesRelatedInstances reaches the expected count. These counts are per
+# acquisition, so they are only trusted for series whose images show a single acquisition (see ACQUISITION_TAGS).
+EXPECTED_COUNT_TAGS = {
+    'GE': 'ImagesInAcquisition',
+}
+# Image-level attributes that exceed 1 in series with several acquisitions, e.g. fMRI and multi-echo series.
+ACQUISITION_TAGS = ('AcquisitionNumber', 'NumberOfTemporalPositions')
+
+
+def expected_count_tag(manufacturer):
+    # pylint: disable=missing-docstring
+    for prefix, tag in EXPECTED_COUNT_TAGS.iteritems():
+        if manufacturer and manufacturer.upper().startswith(prefix):
+            return tag
+    return None
+
+
+def find_wildcard(pattern):
+    """
+    Translate an opt-in regular expression into a C-FIND wildcard value, or return None if it can't be expressed.
+
+    Only literals, escaped punctuation, '.', '.*' and the anchors '^' and '$' translate; an unanchored pattern matches
+    anywhere in the value, like re.search().
+    """
+    anchored_start = pattern.startswith('^')
+    anchored_end = pattern.endswith('$') and not pattern.endswith('\\$')
+    body = pattern[int(anchored_start):len(pattern) - int(anchored_end)]
+    wildcard = '' if anchored_start else '*'
+    for token in re.findall(r'\\.|\.\*|.', body):
+        if token == '.*':
+            wildcard += '*'
+        elif token == '.':
+            wildcard += '?'
+        elif re.match(r'^\\[^\w*?\\]$', token):
+            wildcard += token[1]
+        elif re.match(r'^[\w \-:/,@#&%~]$', token):
+            wildcard += token
+        else:
+            return None
+    wildcard += '' if anchored_end else '*'
+    return re.sub(r'\*+', '*', wildcard)
+
+
+class StudyBatch(object):
+
+    """
+    StudyBatch holds the ready series of one study that are moved with a single study-level C-MOVE.
+
+    The first series reaped from the batch triggers the move, while the others wait on the lock. Received instances are
+    split into per-series directories by SeriesInstanceUID; those of series outside the batch are discarded. The
+    directory is released once every series of the batch has been taken.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, study_uid, series):
+        self.study_uid = study_uid
+        self.series = series  # image counts by SeriesInstanceUID
+        self.pending = set(series)
+        self.lock = threading.Lock()
+        self.path = None
+        self.series_paths = {}
+        self.img_cnts = None
+
 
 class DicomReaper(reaper.Reaper):
 
     """DicomReaper class"""
 
     def __init__(self, options):
-        self.scu = scu.SCU(options.get('host'), options.get('port'), options.get('return_port'), options.get('aet'), options.get('aec'))
+        self.receiver = None
+        transfer_syntax = options.get('transfer_syntax')
+        if options.get('shared_scp'):
+            spool_path = os.path.join(options.get('tempdir') or tempfile.gettempdir(), 'reaper_spool')
+            self.receiver = scp.StorageSCP(options.get('return_port'), options.get('aet'), spool_path, transfer_syntax)
+        self.scu = scu.SCU(options.get('host'), options.get('port'), options.get('return_port'), options.get('aet'), options.get('aec'),
+                           self.receiver, transfer_syntax)
         super(DicomReaper, self).__init__(self.scu.aec, options)
         self.de_identify = options.get('de_identify')
+        self.incremental = options.get('incremental')
+        self.expected_count_tag = options.get('expected_count_tag')
+        memory_limit = options.get('pkg_memory_limit')
+        self.pkg_pool = packaging.PackagingPool(options.get('pkg_workers') or 0, options.get('pkg_timeout'),
+                                                memory_limit * 1024 * 1024 if memory_limit else None)
+        if self.reap_jobs > 1 and self.receiver is None:
+            log.warning('Concurrent reaping requires --shared-scp, reaping one series at a time')
+            self.reap_jobs = 1
+        self.probe = options.get('probe')
+        self.find_wildcard = None
+        if options.get('find_opt_in'):
+            self.find_wildcard = find_wildcard(options['opt_in'][1]) if self.opt == 'in' else None
+            if self.find_wildcard is None:
+                log.warning('--find-opt-in requires an --opt-in value without regular expression syntax, filtering locally')
+        self.find_excluded = set()
+        self.find_checked = {}  # opt values of studies missing from the wildcard C-FIND, by StudyInstanceUID
+        self.avoided = collections.Counter()
+        self.avoided_lock = threading.Lock()
+        self.study_batch = options.get('study_batch')
+        self.batched = {}
+        self.instances = None
+        if options.get('delta_reap') and options.get('persistence_file'):
+            self.instances = instances.InstanceCache(options['persistence_file'] + '.instances')
+        self.pending_instances = {}
+        self.single_acquisition = {}  # (image count, result) of the last acquisition check, by SeriesInstanceUID
 
         self.query_tags = {self.map_key: ''}
         if self.opt_key is not None:
-            self.query_tags[self.opt_key] = ''
+            self.query_tags[self.opt_key] = self.find_wildcard or ''
+        self.series_query_tags = dict(self.query_tags, Manufacturer='')
+        if self.opt_key is not None:
+            self.series_query_tags[self.opt_key] = ''  # never drop series from the listing by wildcard
+        for tag in EXPECTED_COUNT_TAGS.values() + [self.expected_count_tag]:
+            if tag:
+                self.series_query_tags[tag] = ''
+
+    def before_run(self):
+        if self.receiver is not None:
+            self.receiver.start()
+
+    def after_run(self):
+        if self.receiver is not None:
+            self.receiver.stop()
+        self.pkg_pool.close()
+        if self.avoided:
+            log.warning('Transfers    %s', self.avoided_summary())
+
+    def halt(self):
+        super(DicomReaper, self).halt()
+        self.scu.terminate()
 
     def state_str(self, _id, state=None):
         if state:
@@ -33,54 +164,371 @@ class DicomReaper(reaper.Reaper):
     def instrument_query(self):
         i_state = {}
         scu_studies = None
-        scu_series = self.scu.find(scu.SeriesQuery(**scu.SCUQuery(**self.query_tags)))
+        scu_series = self.scu.find(scu.SeriesQuery(**scu.SCUQuery(**self.series_query_tags)))
         if scu_series is None:
             return None
         for series in scu_series:
-            if not series['NumberOfSeriesRelatedInstances']:
-                scu_images = self.scu.find(scu.ImageQuery(**scu.SCUQuery(SeriesInstanceUID=series.SeriesInstanceUID)))
-                if scu_images is None:
-                    return None
-                series['NumberOfSeriesRelatedInstances'] = len(scu_images)
             if self.opt and series[self.opt_key] is None:
                 if scu_studies is None:
                     scu_studies = self.scu.find(scu.StudyQuery(**scu.SCUQuery(**self.query_tags)))
                     if scu_studies is None:
                         return None
                     scu_studies = {study.StudyInstanceUID: study for study in scu_studies}
-                series[self.opt_key] = scu_studies.get(series.StudyInstanceUID, {}).get(self.opt_key)
+                if self.find_wildcard is not None and series.StudyInstanceUID not in scu_studies:
+                    series[self.opt_key] = self.__find_check(series.StudyInstanceUID)
+                    if not self.is_desired_item(series[self.opt_key]):
+                        self.__find_exclude(series)
+                        continue
+                else:
+                    series[self.opt_key] = scu_studies.get(series.StudyInstanceUID, {}).get(self.opt_key)
+            if not series['NumberOfSeriesRelatedInstances']:
+                scu_images = self.scu.find(scu.ImageQuery(**scu.SCUQuery(SeriesInstanceUID=series.SeriesInstanceUID)))
+                if scu_images is None:
+                    return None
+                series['NumberOfSeriesRelatedInstances'] = len(scu_images)
             state = {
                 'images': int(series['NumberOfSeriesRelatedInstances']),
                 '_id': series[self.map_key],
                 'opt': series[self.opt_key] if self.opt is not None else None,
             }
-            i_state[series['SeriesInstanceUID']] = reaper.ReaperItem(state)
+            info = self.__completion_info(series)
+            if self.study_batch:
+                info['study'] = series['StudyInstanceUID']
+            i_state[series['SeriesInstanceUID']] = reaper.ReaperItem(state, **info)
+        listed_studies = set(series.StudyInstanceUID for series in scu_series)
+        self.find_excluded &= set(series.SeriesInstanceUID for series in scu_series)
+        self.find_checked = {uid: value for uid, value in self.find_checked.iteritems() if uid in listed_studies}
+        self.single_acquisition = {uid: value for uid, value in self.single_acquisition.iteritems() if uid in i_state}
         return i_state
 
+    def __find_check(self, study_uid):
+        """
+        Return the opt value of a study missing from the wildcard C-FIND, looking it up without the wildcard once.
+
+        PACS wildcard matching is usually case-sensitive while opt-in matching is not, so a missing study is only
+        excluded if its actual value doesn't match locally. None is returned, and not remembered, if the lookup fails.
+        """
+        if study_uid not in self.find_checked:
+            scu_studies = self.scu.find(scu.StudyQuery(**scu.SCUQuery(StudyInstanceUID=study_uid, **{self.opt_key: ''})))
+            if not scu_studies:
+                return None
+            self.find_checked[study_uid] = scu_studies[0].get(self.opt_key)
+        return self.find_checked[study_uid]
+
+    def __find_exclude(self, series):
+        """Count a series whose study did not match the opt-in wildcard, the first time it is seen."""
+        if series.SeriesInstanceUID in self.find_excluded:
+            return
+        self.find_excluded.add(series.SeriesInstanceUID)
+        images = int(series['NumberOfSeriesRelatedInstances'] or 0)
+        log.info('Excluded     %s (non-matching opt-%s in C-FIND)', series.SeriesInstanceUID, self.opt)
+        self.__count_avoided('find', images, images * IMAGE_SIZE_ESTIMATE)
+
+    def __count_avoided(self, how, images, nbytes):
+        # pylint: disable=missing-docstring
+        with self.avoided_lock:
+            self.avoided[how + '_series'] += 1
+            self.avoided[how + '_images'] += images
+            self.avoided[how + '_bytes'] += nbytes
+
+    def avoided_summary(self):
+        """Describe the transfers avoided by C-FIND filtering and probing, and those discarded after a full move."""
+        with self.avoided_lock:
+            avoided = self.avoided.copy()
+        return 'avoided by C-FIND %d series, %d images [~%s]; avoided by probe %d series, %d images [~%s]; discarded %d series [%s]' % (
+            avoided['find_series'], avoided['find_images'], util.hrsize(avoided['find_bytes']),
+            avoided['probe_series'], avoided['probe_images'], util.hrsize(avoided['probe_bytes']),
+            avoided['discarded_series'], util.hrsize(avoided['discarded_bytes']),
+        )
+
+    def __completion_info(self, series):
+        """
+        Return the expected image count of a series, if the manufacturer rules or options provide one.
+
+        A count from the manufacturer rules only counts once the series has reached it as a single acquisition.
+        """
+        tag = self.expected_count_tag or expected_count_tag(series.get('Manufacturer'))
+        try:
+            expected = int(series.get(tag) or 0)
+        except ValueError:
+            expected = 0
+        if expected <= 0:
+            return {}
+        images = int(series['NumberOfSeriesRelatedInstances'])
+        if not self.expected_count_tag and images == expected and not self.__is_single_acquisition(series.SeriesInstanceUID, images):
+            return {}
+        return {'expected': expected}
+
+    def __is_single_acquisition(self, series_uid, images):
+        """Return whether no image of a series reports more than one acquisition, querying once per image count."""
+        cached = self.single_acquisition.get(series_uid)
+        if cached is not None and cached[0] == images:
+            return cached[1]
+        query_tags = {tag: '' for tag in ACQUISITION_TAGS}
+        scu_images = self.scu.find(scu.ImageQuery(**scu.SCUQuery(SeriesInstanceUID=series_uid, **query_tags)))
+        if not scu_images:
+            return False  # unknown, wait for the series to be quiet
+        single = True
+        for image in scu_images:
+            for tag in ACQUISITION_TAGS:
+                try:
+                    single = single and int(image.get(tag) or 0) <= 1
+                except ValueError:
+                    pass
+        if not single:
+            log.info('Waiting      %s (%d images, several acquisitions)', series_uid, images)
+        self.single_acquisition[series_uid] = (images, single)
+        return single
+
+    def before_reap_queue(self, reap_queue):
+        """Batch the ready series of studies with at least study_batch of them and most of their images ready."""
+        if not self.study_batch:
+            return
+        ready = collections.defaultdict(dict)
+        for _id, item in reap_queue:
+            opt = item['state']['opt']
+            if not item.get('study') or not item['state']['images'] or not self.is_desired_item(opt):
+                continue
+            if self.probe and self.opt is not None and opt is None:
+                continue  # probed on its own
+            if self.instances is not None and self.instances.get(_id, item['state']) is not None:
+                continue  # delta reaped on its own
+            ready[item['study']][_id] = item['state']['images']
+        ready = {study_uid: series for study_uid, series in ready.iteritems() if len(series) >= self.study_batch}
+        if not ready:
+            return
+        study_images = collections.Counter()
+        for item in self.state.itervalues():
+            if item.get('study') in ready:
+                study_images[item['study']] += item['state']['images']
+        for study_uid, series in ready.iteritems():
+            ready_images = sum(series.itervalues())
+            if ready_images < STUDY_BATCH_FRACTION * study_images[study_uid]:
+                log.info('Unbatched    study %s, %d of %d images ready', study_uid, ready_images, study_images[study_uid])
+                continue
+            log.info('Batching     study %s, %d series with %d of %d images', study_uid, len(series), ready_images, study_images[study_uid])
+            self.batched.update(dict.fromkeys(series, StudyBatch(study_uid, series)))
+
+    def after_reap_queue(self):
+        for batch in set(self.batched.itervalues()):
+            if batch.path is not None:
+                self.temp.discard(batch.path)
+        self.batched = {}
+
+    def size_hint(self, _id, item):
+        return 2 * IMAGE_SIZE_ESTIMATE * item['state']['images']
+
+    def is_complete(self, _id, item):
+        return item['state']['images'] == item.get('expected')
+
     def reap(self, _id, item, tempdir):
+        # pylint: disable=too-many-return-statements
         if item['state']['images'] == 0:
             log.warning('Ignoring     %s (zero images)', _id)
             return None, {}
-        if not self.is_desired_item(item['state']['opt']):
+        if not self.is_desired_item(item['state']['opt']) or self.__probe_rejects(_id, item, tempdir):
             log.warning('Ignoring     %s (non-matching opt-%s)', _id, self.opt)
             return None, {}
         reapdir = os.path.join(tempdir, 'raw_dicoms')
         os.mkdir(reapdir)
         log.warning('Reaping      %s', self.state_str(_id, item['state']))
-        start = datetime.datetime.utcnow()
-        success, reap_cnt = self.scu.move(scu.SeriesQuery(SeriesInstanceUID=_id), reapdir)
-        duration = (datetime.datetime.utcnow() - start).total_seconds()
-        log.info('Reaped       %s, %d images in %.1fs [%.0f/s]', _id, reap_cnt, duration, reap_cnt / duration)
+        record = self.instances.get(_id, item['state']) if self.instances is not None else None
+        if record is not None:
+            result = self.__reap_delta(_id, item, record, reapdir)
+            if result is not None:
+                return result
+        reap_cnt = self.__take_batched(_id, item, reapdir)
+        success = reap_cnt is not None
+        if not success and self.incremental:
+            return self.__reap_incremental(_id, item, reapdir)
+        if not success:
+            start = datetime.datetime.utcnow()
+            with trace.span('move') as span:
+                success, reap_cnt = self.scu.move(scu.SeriesQuery(SeriesInstanceUID=_id), reapdir)
+            if span:
+                span['files'], span['bytes'] = trace.dir_size(reapdir)
+            duration = (datetime.datetime.utcnow() - start).total_seconds()
+            log.info('Reaped       %s, %d images in %.1fs [%.0f/s]', _id, reap_cnt, duration, reap_cnt / duration)
         if success and reap_cnt > 0:
             df = dcm.DicomFile(os.path.join(reapdir, os.listdir(reapdir)[0]), self.map_key, self.opt_key)
             if not self.is_desired_item(df.opt):
                 log.warning('Ignoring     %s (non-matching opt-%s)', _id, self.opt)
+                self.__count_avoided('discarded', 0, trace.dir_size(reapdir)[1])
                 return None, {}
         if success and reap_cnt == item['state']['images']:
             log.warning('Processing   %s', self.state_str(_id))
-            metadata_map = dcm.pkg_series(_id, reapdir, self.map_key, self.opt_key, self.de_identify, self.timezone)
-            return True, metadata_map
+            self.__record_instances(_id, item, reapdir)
+            return self.__package(_id, reapdir)
+        else:
+            return False, {}
+
+    def __reap_delta(self, _id, item, record, reapdir):
+        """
+        Move and package only the instances of a grown series that were not uploaded yet, into a delta archive.
+
+        Return None without moving anything if the instances on the instrument don't add up to the known ones plus
+        new ones, e.g. because some were removed, so that the series is reaped in full.
+        """
+        images = self.scu.find(scu.ImageQuery(**scu.SCUQuery(SeriesInstanceUID=_id, SOPInstanceUID='')))
+        known = set(record['sop_uids'])
+        missing = [image['SOPInstanceUID'] for image in images if image.get('SOPInstanceUID') and image['SOPInstanceUID'] not in known]
+        if not missing or len(known) + len(missing) != item['state']['images']:
+            log.warning('Reaping      %s in full, %d known and %d new images', _id, len(known), len(missing))
+            return None
+        log.warning('Reaping      %s, %d new images', _id, len(missing))
+        start = datetime.datetime.utcnow()
+        with trace.span('move', files=len(missing)):
+            for i in xrange(0, len(missing), MOVE_UIDS_PER_QUERY):
+                query = scu.ImageQuery(StudyInstanceUID=images[0]['StudyInstanceUID'], SeriesInstanceUID=_id,
+                                       SOPInstanceUID='\\'.join(missing[i:i + MOVE_UIDS_PER_QUERY]))
+                success, _ = self.scu.move(query, reapdir)
+                if not success:
+                    return False, {}
+        reap_cnt = len(os.listdir(reapdir))
+        duration = (datetime.datetime.utcnow() - start).total_seconds()
+        log.info('Reaped       %s, %d new images in %.1fs [%.0f/s]', _id, reap_cnt, duration, reap_cnt / duration)
+        if reap_cnt != len(missing):
+            return False, {}
+        log.warning('Processing   %s', self.state_str(_id))
+        self.__record_instances(_id, item, reapdir, record)
+        return self.__package(_id, reapdir, '_delta%d' % (record['deltas'] + 1))
+
+    def __record_instances(self, _id, item, reapdir, record=None):
+        """Note the instances in reapdir, added to those of the record of a delta reap, to be recorded once uploaded."""
+        if self.instances is None:
+            return
+        uids = dcm.instance_uids(reapdir)
+        if record is None:
+            self.pending_instances[_id] = (item['state'], uids, 0)
+        else:
+            self.pending_instances[_id] = (item['state'], uids | set(record['sop_uids']), record['deltas'] + 1)
+
+    def after_reap_success(self, _id):
+        pending = self.pending_instances.pop(_id, None)
+        if pending is not None:
+            self.instances.add(_id, *pending)
+
+    def after_reap(self, _id):
+        self.pending_instances.pop(_id, None)
+
+    def after_purge(self, _id):
+        if self.instances is not None:
+            self.instances.remove(_id)
+
+    def __take_batched(self, _id, item, reapdir):
+        """
+        Move the images of a batched series from the study-level move into reapdir and return their count, or None if
+        the series is not batched or its images did not all arrive, so that it is moved on its own.
+        """
+        batch = self.batched.get(_id)
+        if batch is None:
+            return None
+        with batch.lock:
+            if batch.img_cnts is None:
+                self.__move_study(batch)
+            reap_cnt = batch.img_cnts.get(_id, 0)
+            if reap_cnt == item['state']['images']:
+                series_path = batch.series_paths[_id]
+                for filename in os.listdir(series_path):
+                    shutil.move(os.path.join(series_path, filename), reapdir)  # renames unless on another tier
+            batch.pending.discard(_id)
+            if not batch.pending and batch.path is not None:
+                self.temp.discard(batch.path)
+                batch.path = None
+        if reap_cnt != item['state']['images']:
+            log.warning('Unbatching   %s, received %d of %d images with the study', _id, reap_cnt, item['state']['images'])
+            return None
+        return reap_cnt
+
+    def __move_study(self, batch):
+        """Move all images of the study of a batch at once, called by the first series reaped from it."""
+        batch.img_cnts = {}
+        if not self.temp.has_space(2 * IMAGE_SIZE_ESTIMATE * sum(batch.series.itervalues())):
+            log.warning('Unbatching   study %s (low temp space: %s)', batch.study_uid, self.temp.usage())
+            return
+        batch.path = self.temp.mkdtemp()
+        for series_uid in batch.series:
+            batch.series_paths[series_uid] = os.path.join(batch.path, series_uid)
+            os.mkdir(batch.series_paths[series_uid])
+        spool_path = os.path.join(batch.path, 'spool')
+        os.mkdir(spool_path)
+        log.warning('Reaping      study %s, %d series in one C-MOVE', batch.study_uid, len(batch.series))
+        start = datetime.datetime.utcnow()
+        with trace.span('move') as span:
+            success, batch.img_cnts = self.scu.move_study(batch.study_uid, batch.series_paths, spool_path)
+        reap_cnt = sum(batch.img_cnts.itervalues())
+        span['files'] = reap_cnt
+        duration = (datetime.datetime.utcnow() - start).total_seconds()
+        log.info('Reaped       study %s, %d images in %.1fs [%.0f/s]', batch.study_uid, reap_cnt, duration, reap_cnt / duration)
+        if not success:
+            log.warning('Study move   %s failed, moving incomplete series on their own', batch.study_uid)
+
+    def __probe_rejects(self, _id, item, tempdir):
+        """
+        Move a single image of a series whose opt value C-FIND did not return, and return True if its opt value shows
+        the series is not wanted. A failed probe returns False, leaving the check to the full move.
+        """
+        if not self.probe or self.opt is None or item['state']['opt'] is not None or item['state']['images'] < 2:
+            return False
+        images = self.scu.find(scu.ImageQuery(**scu.SCUQuery(SeriesInstanceUID=_id, SOPInstanceUID='')))
+        images = [image for image in images or [] if image.get('SOPInstanceUID')]
+        if not images:
+            return False
+        probedir = os.path.join(tempdir, 'probe')
+        os.mkdir(probedir)
+        try:
+            query = scu.ImageQuery(StudyInstanceUID=images[0]['StudyInstanceUID'], SeriesInstanceUID=_id, SOPInstanceUID=images[0]['SOPInstanceUID'])
+            with trace.span('probe', files=1):
+                success, probe_cnt = self.scu.move(query, probedir)
+            if not success or not probe_cnt:
+                return False
+            probe_path = os.path.join(probedir, os.listdir(probedir)[0])
+            if self.is_desired_item(dcm.DicomFile(probe_path, self.map_key, self.opt_key).opt):
+                return False
+            remaining = item['state']['images'] - 1
+            self.__count_avoided('probe', remaining, remaining * os.path.getsize(probe_path))
+            return True
+        except dcm.DicomFileError:
+            return False
+        finally:
+            shutil.rmtree(probedir, ignore_errors=True)
+
+    def __package(self, _id, reapdir, name_suffix=''):
+        # pylint: disable=missing-docstring
+        try:
+            with trace.span('package'):
+                return True, self.pkg_pool.package(_id, reapdir, self.map_key, self.opt_key, self.de_identify, self.timezone, name_suffix)
+        except packaging.PackagingError as ex:
+            log.error('Packaging    %s failed: %s', _id, ex)
+            return False, {}
+
+    def __reap_incremental(self, _id, item, reapdir):
+        """Package images while the C-MOVE is still running."""
+        settle_time = 0 if self.receiver is not None else 1.0  # the shared receiver only hands over complete files
+        packager = dcm.SeriesPackager(_id, reapdir, self.map_key, self.opt_key, self.de_identify, self.timezone, settle_time)
+        done = threading.Event()
+        watcher = threading.Thread(target=packager.watch, args=(done, self.is_desired_item))
+        watcher.start()
+        start = datetime.datetime.utcnow()
+        try:
+            with trace.span('move') as span:
+                success, reap_cnt = self.scu.move(scu.SeriesQuery(SeriesInstanceUID=_id), reapdir)
+            span['files'] = reap_cnt
+        finally:
+            done.set()
+            watcher.join()
+        duration = (datetime.datetime.utcnow() - start).total_seconds()
+        log.info('Reaped       %s, %d images in %.1fs [%.0f/s]', _id, reap_cnt, duration, reap_cnt / duration)
+        if packager.discarded:
+            log.warning('Ignoring     %s (non-matching opt-%s)', _id, self.opt)
+            packager.abort()
+            return None, {}
+        if success and reap_cnt == item['state']['images'] and packager.error is None:
+            self.__record_instances(_id, item, reapdir)
+            with trace.span('finish'):
+                return True, packager.finish()
         else:
+            packager.abort()
             return False, {}
 
 
@@ -93,6 +541,20 @@ def update_arg_parser(ap):
     ap.add_argument('aec', help='remote AE title')
 
     ap.add_argument('--de-identify', action='store_true', help='de-identify data before upload')
+    ap.add_argument('--incremental', action='store_true', help='package images while they are being received')
+    ap.add_argument('--shared-scp', action='store_true', help='receive all C-MOVEs through one long-lived storage SCP on the return port')
+    ap.add_argument('--pkg-workers', type=int, help='number of supervised packaging processes [0, package in the reaper process]')
+    ap.add_argument('--pkg-timeout', type=int, help='time limit for packaging one series in a worker process [1800s]')
+    ap.add_argument('--pkg-memory-limit', type=int, help='address space limit per packaging process in MB [unlimited]')
+    ap.add_argument('--transfer-syntax', choices=sorted(scu.TRANSFER_SYNTAX_OPTIONS),
+                    help='transfer syntax to prefer for received images; the PACS may still send them uncompressed [uncompressed]')
+    ap.add_argument('--find-opt-in', action='store_true', help='match --opt-in in C-FIND with wildcards, checking non-matching studies once without')
+    ap.add_argument('--probe', action='store_true', help='move one image to check the opt value before moving a series C-FIND left it unknown for')
+    ap.add_argument('--study-batch', type=int, metavar='N',
+                    help='move a study with one C-MOVE when N or more of its series and most of its images are ready [off]')
+    ap.add_argument('--delta-reap', action='store_true',
+                    help='when a reaped series grows, move and upload only its new images, as a separate delta archive')
+    ap.add_argument('--expected-count-tag', help='series attribute holding the final image count, regardless of manufacturer')
 
     return ap
 
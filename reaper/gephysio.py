@@ -5,60 +5,212 @@
 import os
 import re
 import time
-import shutil
+import bisect
 import datetime
+import threading
 
 from . import util
 from . import reaper
+from . import staging
 from . import tempdir as tempfile
 
 import scitran.data.medimg.gephysio
 
+PSD_NAME_RE = re.compile(r'^[a-zA-Z0-9_+-]+$')
+TIMESTAMP_FORMAT = '%m%d%Y%H_%M_%S_%f'
+TIMESTAMP_FIELDS = TIMESTAMP_FORMAT.count('_') + 1
+GIVE_UP_AFTER = datetime.timedelta(minutes=15)
+MAX_INDEX_AGE = 300
 
-def reap(name, data_path, reap_path, reap_data, reap_name, log, log_info, tempdir):
-    if not reap_data.psd_name or not re.match(r'^[a-zA-Z0-9_+-]+$', reap_data.psd_name):
-        log.warning('periph data  %s %s invalid PSD name' % (log_info, name))
-        return
-    lower_time_bound = reap_data.timestamp + datetime.timedelta(seconds=reap_data.prescribed_duration or 0) - datetime.timedelta(seconds=15)
-    upper_time_bound = lower_time_bound + datetime.timedelta(seconds=180)
-    sleep_time = (upper_time_bound - datetime.datetime.now()).total_seconds()
-    if sleep_time > 0:
-        log.info('periph data  %s waiting for %s for %ds' % (log_info, name, sleep_time))
-        time.sleep(sleep_time)
-    for i in range(15):
+DEFERRED = {}
+DEFERRED_LOCK = threading.Lock()
+
+
+class PhysioIndex(object):
+
+    """
+    Sorted (timestamp, filename) lists of a physio directory, keyed by the filename part before the timestamp.
+
+    Physio files are named <type>_<psd name>_<timestamp>. refresh() only parses files that appeared since the last
+    refresh, and only lists the directory if its mtime changed or the last listing is older than max_age seconds
+    (mtimes are coarse and cached on network mounts). lookup() finds the files of a PSD within a time window by
+    bisection.
+    """
+
+    def __init__(self, data_path, max_age=MAX_INDEX_AGE):
+        self.data_path = data_path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.index = {}
+        self.names = set()
+        self.mtime = None
+        self.listed_at = None
+
+    def refresh(self):
+        """Update the index from the directory; return False if the directory is unavailable."""
+        now = time.time()
         try:
-            physio_files = os.listdir(data_path)
+            mtime = os.stat(self.data_path).st_mtime
+            if mtime == self.mtime and now - self.listed_at < self.max_age:
+                return True
+            names = set(os.listdir(self.data_path))
         except OSError:
-            physio_files = []
-        if physio_files:
-            break
+            return False
+        with self.lock:
+            for pfn in names - self.names:
+                self.__add(pfn)
+            for pfn in self.names - names:
+                self.__remove(pfn)
+            self.names, self.mtime, self.listed_at = names, mtime, now
+        return True
+
+    def lookup(self, psd_name, lower_bound, upper_bound):
+        """Return the filenames of psd_name with timestamps in [lower_bound, upper_bound], in time order."""
+        matches = []
+        with self.lock:
+            for key, entries in self.index.iteritems():
+                if key.endswith('_' + psd_name):
+                    lo = bisect.bisect_left(entries, (lower_bound, ''))
+                    hi = bisect.bisect_right(entries, (upper_bound, '\xff'))
+                    matches.extend(entries[lo:hi])
+        return [pfn for _, pfn in sorted(matches)]
+
+    @staticmethod
+    def parse(pfn):
+        """Split a physio filename into key and timestamp, or return None if it does not match."""
+        parts = pfn.split('_')
+        if len(parts) < TIMESTAMP_FIELDS + 2:
+            return None
+        try:
+            timestamp = datetime.datetime.strptime('_'.join(parts[-TIMESTAMP_FIELDS:]), TIMESTAMP_FORMAT)
+        except ValueError:
+            return None
+        return '_'.join(parts[:-TIMESTAMP_FIELDS]), timestamp
+
+    def __add(self, pfn):
+        parsed = self.parse(pfn)
+        if parsed is not None:
+            key, timestamp = parsed
+            bisect.insort(self.index.setdefault(key, []), (timestamp, pfn))
+
+    def __remove(self, pfn):
+        parsed = self.parse(pfn)
+        if parsed is not None:
+            key, timestamp = parsed
+            entries = self.index.get(key, [])
+            i = bisect.bisect_left(entries, (timestamp, pfn))
+            if i < len(entries) and entries[i] == (timestamp, pfn):
+                del entries[i]
+
+
+def time_window(reap_data):
+    lower_time_bound = reap_data.timestamp + datetime.timedelta(seconds=reap_data.prescribed_duration or 0) - datetime.timedelta(seconds=15)
+    upper_time_bound = lower_time_bound + datetime.timedelta(seconds=180)
+    return lower_time_bound, upper_time_bound
+
+
+def package(physio_files, data_path, reap_path, reap_data, reap_name, log, log_info, tempdir):
+    with tempfile.TemporaryDirectory(dir=tempdir) as tempdir_path:
+        metadata = {
+            'filetype': scitran.data.medimg.gephysio.GEPhysio.filetype,
+            'timezone': reap_data.nims_timezone,
+            'header': {
+                'group': reap_data.nims_group_id,
+                'project': reap_data.nims_project,
+                'session': reap_data.nims_session_id,
+                'acquisition': reap_data.nims_acquisition_id,
+                'timestamp': reap_data.nims_timestamp,
+            },
+        }
+        physio_reap_path = os.path.join(tempdir_path, reap_name)
+        os.mkdir(physio_reap_path)
+        stager = staging.Stager()
+        for pfn in physio_files:
+            stager.stage(os.path.join(data_path, pfn), os.path.join(physio_reap_path, pfn))
+        arc_path = util.create_archive(physio_reap_path, reap_name, metadata, reap_path)
+        log.debug('periph data  %s %s' % (log_info, stager.summary()))
+    return arc_path
+
+
+def reap(name, data_path, reap_data, reap_name, log, log_info, tempdir, callback):
+    """
+    Attach the physio files of an acquisition once its time window has passed, without blocking the caller.
+
+    Requests are handed to one DeferredPhysio per physio directory; callback receives the path of the physio archive.
+    """
+    with DEFERRED_LOCK:
+        deferred = DEFERRED.get(data_path)
+        if deferred is None:
+            deferred = DEFERRED[data_path] = DeferredPhysio(data_path, log, tempdir)
+    deferred.add(name, reap_data, reap_name, log_info, callback)
+
+
+class DeferredPhysio(object):
+
+    """
+    Attach physio files in the background instead of blocking the reap queue.
+
+    Requests are checked every interval seconds once their time window has passed. Found files are packaged and handed
+    to the request's callback, which must upload or move the archive before returning. Requests are dropped when the
+    physio directory stays unavailable for GIVE_UP_AFTER past the window.
+    """
+
+    def __init__(self, data_path, log, tempdir=None, interval=30):
+        self.data_path = data_path
+        self.log = log
+        self.tempdir = tempdir
+        self.interval = interval
+        self.index = PhysioIndex(data_path)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, name, reap_data, reap_name, log_info, callback):
+        if not reap_data.psd_name or not PSD_NAME_RE.match(reap_data.psd_name):
+            self.log.warning('periph data  %s %s invalid PSD name' % (log_info, name))
+            return
+        lower_time_bound, upper_time_bound = time_window(reap_data)
+        give_up = upper_time_bound + GIVE_UP_AFTER
+        with self.lock:
+            self.pending.append((upper_time_bound, lower_time_bound, give_up, name, reap_data, reap_name, log_info, callback))
+            self.pending.sort()
+        self.log.info('periph data  %s deferred %s until %s' % (log_info, name, upper_time_bound.strftime(reaper.DATE_FORMAT)))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            now = datetime.datetime.now()
+            with self.lock:
+                due = [request for request in self.pending if request[0] <= now]
+            if not due:
+                continue
+            available = self.index.refresh() and self.index.names
+            for request in due:
+                self.__attach(request, now, available)
+
+    def __attach(self, request, now, available):
+        upper_time_bound, lower_time_bound, give_up, name, reap_data, reap_name, log_info, callback = request
+        if not available:
+            if now < give_up:
+                self.log.warning('periph data  %s %s temporarily unavailable' % (log_info, name))
+                return
+            self.log.error('periph data  %s %s permanently unavailable - giving up' % (log_info, name))
         else:
-            log.warning('periph data  %s %s temporarily unavailable' % (log_info, name))
-            time.sleep(60)
-    else:
-        log.error('periph data  %s %s permanently unavailable - giving up' % (log_info, name))
-        return
-    physio_tuples = filter(lambda pt: pt[0], [(re.match('.+_%s_([0-9_]{18,20})$' % reap_data.psd_name, pfn), pfn) for pfn in physio_files])
-    physio_tuples = [(datetime.datetime.strptime(pts.group(1), '%m%d%Y%H_%M_%S_%f'), pfn) for pts, pfn in physio_tuples]
-    physio_tuples = filter(lambda pt: lower_time_bound <= pt[0] <= upper_time_bound, physio_tuples)
-    if physio_tuples:
-        log.info('periph data  %s %s found' % (log_info, name))
-        with tempfile.TemporaryDirectory(dir=tempdir) as tempdir_path:
-            metadata = {
-                'filetype': scitran.data.medimg.gephysio.GEPhysio.filetype,
-                'timezone': reap_data.nims_timezone,
-                'header': {
-                    'group': reap_data.nims_group_id,
-                    'project': reap_data.nims_project,
-                    'session': reap_data.nims_session_id,
-                    'acquisition': reap_data.nims_acquisition_id,
-                    'timestamp': reap_data.nims_timestamp,
-                },
-            }
-            physio_reap_path = os.path.join(tempdir_path, reap_name)
-            os.mkdir(physio_reap_path)
-            for pts, pfn in physio_tuples:
-                shutil.copy2(os.path.join(data_path, pfn), physio_reap_path)
-            util.create_archive(os.path.join(reap_path, reap_name + '.zip'), physio_reap_path, reap_name, metadata)
-    else:
-        log.info('periph data  %s %s not found' % (log_info, name))
+            physio_files = self.index.lookup(reap_data.psd_name, lower_time_bound, upper_time_bound)
+            if physio_files:
+                self.log.info('periph data  %s %s found' % (log_info, name))
+                with tempfile.TemporaryDirectory(dir=self.tempdir) as reap_path:
+                    try:
+                        callback(package(physio_files, self.data_path, reap_path, reap_data, reap_name, self.log, log_info, self.tempdir))
+                    except Exception as ex:
+                        self.log.error('periph data  %s %s attach failed: %s' % (log_info, name, ex))
+            else:
+                self.log.info('periph data  %s %s not found' % (log_info, name))
+        with self.lock:
+            self.pending.remove(request)
@@ -0,0 +1,60 @@
+"""SciTran Reaper record of the instances uploaded per series"""
+
+import os
+import re
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class InstanceCache(object):
+
+    """
+    InstanceCache remembers the SOPInstanceUIDs uploaded for each series.
+
+    A series that grows after it was reaped, e.g. by late reformats or a PACS forwarding it in pieces, can then be
+    completed by moving and uploading only its new instances. Each series is a JSON file in the cache directory,
+    holding the item state it was reaped with, the uploaded SOPInstanceUIDs and the number of delta archives uploaded
+    since the full one. Files are replaced atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __record_path(self, _id):
+        # pylint: disable=missing-docstring
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', _id) + '.json')
+
+    def get(self, _id, state):
+        """Return the record of a series that has grown since it was reaped with an otherwise equal state, or None."""
+        try:
+            with open(self.__record_path(_id)) as fd:
+                record = json.load(fd)
+        except (EnvironmentError, ValueError):
+            return None
+        reaped_state = record['state']
+        if reaped_state['_id'] != state['_id'] or reaped_state['opt'] != state['opt']:
+            return None
+        if state['images'] <= len(record['sop_uids']):
+            return None
+        return record
+
+    def add(self, _id, state, sop_uids, deltas=0):
+        """Record the instances uploaded for a series reaped in state, after deltas delta archives."""
+        record_path = self.__record_path(_id)
+        try:
+            with open(record_path + '.tmp', 'w') as fd:
+                json.dump({'state': state, 'sop_uids': sorted(sop_uids), 'deltas': deltas}, fd)
+            os.rename(record_path + '.tmp', record_path)
+        except EnvironmentError as ex:
+            log.error('Recording    instances of %s failed: %s', _id, ex)
+
+    def remove(self, _id):
+        # pylint: disable=missing-docstring
+        try:
+            os.remove(self.__record_path(_id))
+        except OSError:
+            pass
@@ -0,0 +1,101 @@
+"""SciTran Reaper multipart/form-data file upload over httplib without copying file data in userspace"""
+
+import os
+import ssl
+import mmap
+import errno
+import select
+import socket
+import urllib
+import httplib
+import urlparse
+import binascii
+
+from . import util
+
+CHUNK = 8 * 1024 * 1024
+TIMEOUT = 300  # seconds without progress, also while waiting for the response
+
+
+def post_file(url, fields, file_field, filepath, headers=None, params=None, verify=True, timeout=TIMEOUT):
+    """
+    POST string fields and a file as multipart/form-data and return the response status and reason.
+
+    The multipart preamble and epilogue are framed here, so the Content-Length is known up front and the file body
+    can be sent straight from the page cache: with sendfile() on plain HTTP, and as buffer slices of a memory map on
+    TLS, where the data has to pass through the SSL library anyway. Like in requests, verify is either a bool or the
+    path of a CA bundle. Socket, SSL and HTTP errors are raised, including socket.timeout once the connection has
+    made no progress for timeout seconds.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    parsed = urlparse.urlparse(url)
+    boundary = binascii.hexlify(os.urandom(16))
+    preamble = ''.join('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)
+                       for name, value in fields)
+    preamble += '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n\r\n' % (
+        boundary, file_field, os.path.basename(filepath))
+    epilogue = '\r\n--%s--\r\n' % boundary
+    if parsed.scheme == 'https':
+        if verify:
+            context = ssl.create_default_context(cafile=verify if isinstance(verify, basestring) else None)
+        else:
+            context = ssl._create_unverified_context()  # pylint: disable=protected-access
+        conn = httplib.HTTPSConnection(parsed.hostname, parsed.port, timeout=timeout, context=context)
+    else:
+        conn = httplib.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+    path = (parsed.path or '/') + '?' + '&'.join(filter(None, [parsed.query, urllib.urlencode(params or {})]))
+    try:
+        with open(filepath, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            conn.putrequest('POST', path.rstrip('?'), skip_accept_encoding=True)
+            for name, value in (headers or {}).iteritems():
+                if name.lower() not in ('content-type', 'content-length', 'accept-encoding'):
+                    conn.putheader(name, value)
+            conn.putheader('Content-Type', 'multipart/form-data; boundary=' + boundary)
+            conn.putheader('Content-Length', str(len(preamble) + size + len(epilogue)))
+            conn.endheaders(preamble)
+            if isinstance(conn.sock, ssl.SSLSocket):
+                send_mapped(conn.sock, fd, size)
+            else:
+                send_file(conn.sock, fd, size)
+            conn.send(epilogue)
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.reason
+    finally:
+        conn.close()
+
+
+def send_file(sock, fd, size):
+    """Send size bytes of an open file over a plain socket with sendfile(), falling back to send_mapped()."""
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                sent = util.sendfile(sock.fileno(), fd.fileno(), offset, min(size - offset, util.SENDFILE_CHUNK))
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:  # sockets with a timeout are non-blocking underneath
+                    raise
+                if not select.select([], [sock], [], sock.gettimeout())[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if not sent:
+                raise EnvironmentError(errno.EIO, 'file shrank while sending')
+            offset += sent
+    except OSError as ex:
+        if ex.errno not in (errno.ENOSYS, errno.EINVAL) or offset:
+            raise
+        send_mapped(sock, fd, size)
+
+
+def send_mapped(sock, fd, size):
+    """Send size bytes of an open file as buffer slices of a read-only memory map, without copying them."""
+    if not size:
+        return
+    mapped = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset < size:  # not sendall(), which slices, i.e. copies, what is left on SSL sockets
+            offset += sock.send(buffer(mapped, offset, CHUNK))
+    finally:
+        mapped.close()
@@ -1,10 +1,12 @@
 """ SciTran Orthanc DICOM Reaper """
 
 import logging
-import requests
 
+from . import util
 from . import dicom_reaper
 
+requests = util.LazyModule('requests')  # pylint: disable=invalid-name
+
 log = logging.getLogger('reaper.orthanc')
 
 
@@ -15,11 +17,15 @@ class OrthancReaper(dicom_reaper.DicomReaper):
     def __init__(self, options):
         super(OrthancReaper, self).__init__(options)
         self.orthanc_uri = options.get('orthanc_uri').strip('/')
+        if self.reap_jobs > 1:
+            log.warning('Orthanc store filtering allows reaping one series at a time only')
+            self.reap_jobs = 1
 
     def before_run(self):
         """
         Operations for before the run loop.
         """
+        super(OrthancReaper, self).before_run()
         self._enable_orthanc()
 
     def before_reap(self, _id):
@@ -32,12 +38,14 @@ class OrthancReaper(dicom_reaper.DicomReaper):
         """
         Operations after the series is reaped successfully.
         """
+        super(OrthancReaper, self).after_reap_success(_id)
         self._delete_series(_id)
 
     def after_reap(self, _id):
         """
         Operations after the series is reaped, regardless of result.
         """
+        super(OrthancReaper, self).after_reap(_id)
         self._enable_orthanc()
 
     def _enable_orthanc(self):
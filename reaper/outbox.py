@@ -0,0 +1,199 @@
+"""SciTran Reaper durable upload outbox"""
+
+import os
+import re
+import json
+import shutil
+import logging
+import datetime
+import threading
+
+from . import util
+from . import upload
+
+log = logging.getLogger(__name__)
+
+METADATA_FILE = 'metadata.json'
+INCOMING_PREFIX = '.incoming-'
+FAILED_DIR = 'failed'
+LIMIT = 10 * 1024 * 1024 * 1024
+MIN_RETRY = 10
+MAX_RETRY = 600
+MAX_FAILURES = 10
+
+
+def dir_size(path):
+    # pylint: disable=missing-docstring
+    return sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+
+
+class Outbox(object):
+
+    """
+    Outbox keeps packaged archives and their metadata on disk until they are uploaded.
+
+    Reaping hands archives over with put(), which moves them into an entry directory of the outbox; the item then
+    counts as reaped. A background thread uploads entries in the order they arrived and deletes each archive once it is
+    uploaded, so an interrupted entry resumes with its remaining archives, also after a restart. After a failed upload
+    the uploader waits MIN_RETRY seconds, doubling up to MAX_RETRY while uploads keep failing, and retries entries that
+    failed after the others. An entry that fails MAX_FAILURES times while other entries upload fine is moved
+    to the failed subdirectory for inspection; moving it back re-queues it.
+
+    The outbox is full once it holds limit bytes. Callers should stop reaping then, while the instrument is still
+    polled, and resume once the uploader has made room.
+    """
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = LIMIT if limit is None else limit
+        self.upload_function = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.failures = {}
+        self.success_cnt = 0
+        for dir_path in (path, os.path.join(path, FAILED_DIR)):
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+        for name in os.listdir(path):
+            if name.startswith(INCOMING_PREFIX):
+                log.warning('Removing     incomplete outbox entry %s', name)
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+        self.size = sum(dir_size(os.path.join(path, name)) for name in self.entries())
+        if self.size:
+            log.warning('Outbox       %d entries [%s] left to upload', len(self.entries()), util.hrsize(self.size))
+
+    @property
+    def full(self):
+        # pylint: disable=missing-docstring
+        self.__check_uploader()
+        return self.size >= self.limit
+
+    def usage(self):
+        # pylint: disable=missing-docstring
+        return '%d entries [%s of %s]' % (len(self.entries()), util.hrsize(self.size), util.hrsize(self.limit))
+
+    def entries(self):
+        """Return the names of the complete entries, oldest first."""
+        return sorted(name for name in os.listdir(self.path) if not name.startswith('.') and name != FAILED_DIR)
+
+    def put(self, _id, metadata_map):
+        """Move the archives of metadata_map into a new entry and return True, or False if that failed."""
+        self.__check_uploader()
+        now = datetime.datetime.utcnow()
+        name = now.strftime('%Y%m%d%H%M%S%f') + '_' + re.sub(r'[^\w.-]', '_', _id)
+        incoming_path = os.path.join(self.path, INCOMING_PREFIX + name)
+        try:
+            os.mkdir(incoming_path)
+            metadata = {}
+            for filepath, file_metadata in metadata_map.iteritems():
+                shutil.move(filepath, incoming_path)
+                metadata[os.path.basename(filepath)] = file_metadata
+            with open(os.path.join(incoming_path, METADATA_FILE), 'w') as fd:
+                json.dump(metadata, fd, default=util.metadata_encoder)
+            size = dir_size(incoming_path)
+            os.rename(incoming_path, os.path.join(self.path, name))
+        except (EnvironmentError, TypeError, ValueError) as ex:
+            log.error('Outbox       failed to store %s: %s', _id, ex)
+            shutil.rmtree(incoming_path, ignore_errors=True)
+            return False
+        with self.lock:
+            self.size += size
+        log.info('Handed off   %s to outbox [%s]', _id, util.hrsize(size))
+        self.wakeup.set()
+        return True
+
+    def start(self, upload_function):
+        """Start uploading entries in the background with upload_function."""
+        self.upload_function = upload_function
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __check_uploader(self):
+        """Report and restart an uploader thread that died, so that the outbox doesn't fill up for good."""
+        with self.lock:
+            if self.thread is not None and not self.thread.is_alive() and not self.stopped.is_set():
+                log.error('Outbox       uploader stopped unexpectedly, restarting it')
+                self.start(self.upload_function)
+
+    def stop(self):
+        """Stop the uploader after the upload in progress; remaining entries are uploaded after a restart."""
+        if self.thread is not None:
+            self.stopped.set()
+            self.wakeup.set()
+            self.thread.join()
+
+    def __run(self):
+        # pylint: disable=missing-docstring
+        retry = 0
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            try:
+                entries = sorted(self.entries(), key=lambda name: name in self.failures)  # failed entries last, stable
+            except EnvironmentError as ex:
+                log.error('Outbox       cannot list entries: %s', ex)
+                entries = []
+            if not entries:
+                self.wakeup.wait(MAX_RETRY)
+                continue
+            for name in entries:
+                if self.stopped.is_set():
+                    break
+                if not self.__try_upload_entry(name):
+                    retry = min(max(2 * retry, MIN_RETRY), MAX_RETRY)
+                    log.warning('Outbox       retrying in %ds, %s', retry, self.usage())
+                    self.stopped.wait(retry)
+                    break
+                retry = 0
+
+    def __try_upload_entry(self, name):
+        """Upload an entry like __upload_entry(), counting any unexpected error as a failure of the entry."""
+        try:
+            return self.__upload_entry(name)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Outbox       failed to upload %s', name)
+        try:
+            self.__failed(name)
+        except EnvironmentError as ex:
+            log.error('Outbox       cannot shelve %s: %s', name, ex)
+        return False
+
+    def __upload_entry(self, name):
+        """Upload the remaining archives of an entry, removing the entry when done; return False on failure."""
+        entry_path = os.path.join(self.path, name)
+        with open(os.path.join(entry_path, METADATA_FILE)) as fd:
+            metadata = json.load(fd)
+        for filename in sorted(metadata):
+            filepath = os.path.join(entry_path, filename)
+            if not os.path.exists(filepath):
+                continue  # uploaded before an interruption
+            size = os.path.getsize(filepath)
+            if not upload.metadata_upload(filepath, metadata[filename], self.upload_function):
+                self.__failed(name)
+                return False
+            os.remove(filepath)
+            with self.lock:
+                self.size -= size
+                self.success_cnt += 1
+        with self.lock:
+            self.size -= os.path.getsize(os.path.join(entry_path, METADATA_FILE))
+        shutil.rmtree(entry_path)
+        self.failures.pop(name, None)
+        return True
+
+    def __failed(self, name):
+        """Count a failure of the entry if other uploads succeeded since its last failure, shelving it after MAX_FAILURES."""
+        failure_cnt, success_cnt = self.failures.get(name, (0, -1))
+        if self.success_cnt > success_cnt:
+            failure_cnt += 1
+        self.failures[name] = (failure_cnt, self.success_cnt)
+        if failure_cnt >= MAX_FAILURES:
+            log.error('Outbox       moving %s to %s after %d failures', name, FAILED_DIR, failure_cnt)
+            entry_path = os.path.join(self.path, name)
+            size = dir_size(entry_path)
+            os.rename(entry_path, os.path.join(self.path, FAILED_DIR, name))
+            with self.lock:
+                self.size -= size
+            del self.failures[name]
@@ -0,0 +1,151 @@
+"""SciTran Reaper supervised packaging worker processes"""
+
+import Queue
+import logging
+import resource
+import threading
+import multiprocessing
+
+from . import dcm
+from . import trace
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 1800
+TASKS_PER_WORKER = 16
+
+
+class PackagingError(Exception):
+    """Packaging of a series failed, timed out or crashed its worker"""
+    pass
+
+
+def worker_main(conn, memory_limit):
+    """Package series received on conn until told to stop, with the address space limited to memory_limit bytes."""
+    for handler in logging.root.handlers:
+        handler.createLock()  # a lock may have been held by another thread at fork time
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        task, trace_config = task
+        tracer = trace.Trace(*trace_config) if trace_config else None
+        try:
+            with trace.activate(tracer):
+                result = dcm.pkg_series(*task)
+            conn.send((True, result, tracer.spans if tracer else None))
+        except MemoryError:
+            conn.send((False, 'memory limit exceeded', None))
+        except Exception as ex:  # pylint: disable=broad-except
+            conn.send((False, '%s: %s' % (type(ex).__name__, ex), None))
+    conn.close()
+
+
+class _Worker(object):
+
+    """Worker process and the parent end of its pipe"""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, memory_limit):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main, args=(child_conn, memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.task_cnt = 0
+
+    def stop(self, kill=False):
+        # pylint: disable=missing-docstring
+        if kill:
+            self.process.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (IOError, EOFError):
+                pass
+        self.process.join()
+        self.conn.close()
+
+
+class PackagingPool(object):
+
+    """
+    PackagingPool runs dcm.pkg_series in supervised worker processes and returns its metadata_map.
+
+    A task that exceeds the timeout gets its worker killed; a worker that dies, e.g. by exceeding the memory limit,
+    is replaced. Either way the task raises PackagingError, while other series keep being packaged. Workers are
+    recycled after TASKS_PER_WORKER tasks to cap memory leaked by repeated DICOM parsing. With zero workers, series are
+    packaged in the calling process and only errors are converted. Stages traced in a worker are added to the calling
+    thread's trace.
+    """
+
+    def __init__(self, workers=0, timeout=None, memory_limit=None):
+        self.workers = workers
+        self.timeout = timeout or TIMEOUT
+        self.memory_limit = memory_limit
+        self.idle = Queue.Queue()
+        self.slots = threading.BoundedSemaphore(max(workers, 1))
+        self.closed = False
+
+    def package(self, _id, path, map_key, opt_key=None, de_identify=False, timezone=None, name_suffix=''):
+        """Package a series like dcm.pkg_series, raising PackagingError on failure."""
+        # pylint: disable=too-many-arguments
+        task = (_id, path, map_key, opt_key, de_identify, timezone, name_suffix)
+        if self.workers < 1:
+            try:
+                return dcm.pkg_series(*task)
+            except (dcm.DicomFileError, EnvironmentError, ValueError, AttributeError) as ex:
+                raise PackagingError('%s: %s' % (type(ex).__name__, ex))
+        tracer = trace.current()
+        with self.slots:
+            worker = self.__get_worker()
+            try:
+                worker.conn.send((task, tracer.config if tracer else None))
+                if not worker.conn.poll(self.timeout):
+                    worker.stop(kill=True)
+                    worker = None
+                    raise PackagingError('timed out after %ds' % self.timeout)
+                success, result, spans = worker.conn.recv()
+                if spans:
+                    tracer.extend(spans)
+                if not success:  # don't reuse a worker in an unknown state
+                    worker.stop()
+                    worker = None
+            except (IOError, EOFError):
+                worker.stop(kill=True)
+                worker = None
+                raise PackagingError('worker process died')
+            finally:
+                self.__put_worker(worker)
+        if not success:
+            raise PackagingError(result)
+        return result
+
+    def close(self):
+        """Stop all idle workers."""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().stop()
+            except Queue.Empty:
+                break
+
+    def __get_worker(self):
+        # pylint: disable=missing-docstring
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return _Worker(self.memory_limit)
+
+    def __put_worker(self, worker):
+        # pylint: disable=missing-docstring
+        if worker is None:
+            return
+        worker.task_cnt += 1
+        if self.closed or worker.task_cnt >= TASKS_PER_WORKER:
+            worker.stop()
+        else:
+            self.idle.put(worker)
@@ -56,6 +56,9 @@ class PFileReaper(reaper.Reaper):
             i_state[pf.acquisition_uid] = reaper.ReaperItem(state, path=fp)
         return i_state
 
+    def size_hint(self, _id, item):
+        return item['state']['size']
+
     def reap(self, _id, item, tempdir):
         try:
             pf = PFile(item['path'], self.map_key, self.opt_key)
@@ -4,15 +4,23 @@ import os
 import re
 import sys
 import time
+import heapq
+import Queue
 import signal
 import logging
 import argparse
 import datetime
+import threading
+import collections
 
 
 from . import util
+from . import trace
 from . import upload
-from . import tempdir as tempfile
+from . import outbox
+from . import statedb
+from . import scheduler
+from . import tempmanager
 
 logging.basicConfig(
     format='%(asctime)s %(name)16.16s:%(levelname)4.4s %(message)s',
@@ -21,46 +29,241 @@ logging.basicConfig(
 )
 log = logging.getLogger('reaper')
 
-SLEEPTIME = 60
 GRACEPERIOD = 86400
-OFFDUTY_SLEEPTIME = 300
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+EPOCH = datetime.datetime(1970, 1, 1)
+RETRY_KEYS = ('first_failure', 'retry_at', 'abandoned')
+RETRY_ALL = '*'
 
 
-class ReaperItem(dict):
+def intern_str(value):
+    """Intern ASCII strings so that repeated ids and values share one object."""
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeError:
+            return value
+    return intern(value) if isinstance(value, str) else value
 
-    """ReaperItem class"""
+
+def to_epoch(timestamp):
+    # pylint: disable=missing-docstring
+    return (timestamp.replace(tzinfo=None) - EPOCH).total_seconds()
+
+
+class ReaperItem(object):
+
+    """
+    ReaperItem class
+
+    Slot-based record with dict-style access. Keys other than reaped, failures, lastseen and state (e.g. path or
+    abandoned) are kept in a dict that is only allocated when used. An item that belongs to a ReaperState notifies it
+    of every change, so the state can keep its indexes current and persist only changed items.
+    """
+
+    __slots__ = ('state', 'reaped', 'failures', 'lastseen', 'extra', 'owner', 'id_')
 
     def __init__(self, state, **kwargs):
-        super(ReaperItem, self).__init__()
-        self['reaped'] = False
-        self['failures'] = 0
-        self['lastseen'] = datetime.datetime.utcnow()
-        self['state'] = state
+        self.owner = self.id_ = self.extra = None
+        self.reaped = False
+        self.failures = 0
+        self.lastseen = to_epoch(datetime.datetime.utcnow())
+        self.state = state
         self.update(kwargs)
 
+    def __getitem__(self, key):
+        if key == 'lastseen':
+            return EPOCH + datetime.timedelta(seconds=self.lastseen)
+        elif key in ('reaped', 'failures', 'state'):
+            return getattr(self, key)
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'reaped':
+            self.reaped = value
+        elif key == 'lastseen':
+            self.lastseen = to_epoch(value)
+        elif key in ('failures', 'state'):
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        if self.owner is not None:
+            self.owner.item_changed(self)
+
+    def __contains__(self, key):
+        return key in ('reaped', 'failures', 'lastseen', 'state') or (self.extra is not None and key in self.extra)
+
+    def get(self, key, default=None):
+        # pylint: disable=missing-docstring
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, fields):
+        # pylint: disable=missing-docstring
+        for key, value in fields.iteritems():
+            self[key] = value
+
+    def pop(self, key, default=None):
+        """Remove an extra key and return its value, or default if it is not set."""
+        if self.extra is None or key not in self.extra:
+            return default
+        value = self.extra.pop(key)
+        if self.owner is not None:
+            self.owner.item_changed(self)
+        return value
+
+    def to_dict(self):
+        """Return the item as a plain dict, e.g. for persisting."""
+        dct = dict(self.extra or {})
+        dct.update(reaped=self.reaped, failures=self.failures, lastseen=self['lastseen'], state=self.state)
+        return dct
+
+    @classmethod
+    def from_dict(cls, dct):
+        # pylint: disable=missing-docstring
+        fields = dict(dct)
+        item = cls(fields.pop('state'))
+        item.update(fields)
+        return item
+
+
+class ReaperState(dict):
+
+    """
+    ReaperState class
+
+    Maps item ids to ReaperItems. Ids and string state values are interned. The state keeps a set of unreaped ids and
+    a heap of (lastseen, id) pairs, so counting unreaped items and purging expired ones don't need a full scan. Ids of
+    items changed or removed since the last call to changes() are tracked for incremental persistence.
+    """
+
+    def __init__(self, items=None):
+        super(ReaperState, self).__init__()
+        self.unreaped = set()
+        self.expiry = []
+        self.changed = set()
+        self.removed = set()
+        if items:
+            self.update(items)
+            self.changes()
+
+    def __setitem__(self, _id, item):
+        if not isinstance(item, ReaperItem):
+            item = ReaperItem.from_dict(item)
+        _id = intern_str(_id)
+        previous = self.get(_id)
+        if previous is not None and previous is not item:
+            previous.owner = None
+        if isinstance(item.state, dict):
+            item.state = {intern_str(key): intern_str(value) for key, value in item.state.iteritems()}
+        item.owner, item.id_ = self, _id
+        super(ReaperState, self).__setitem__(_id, item)
+        self.item_changed(item)
+        heapq.heappush(self.expiry, (item.lastseen, _id))
+        if len(self.expiry) > 2 * len(self) + 1024:
+            self.expiry = [(i.lastseen, i_id) for i_id, i in self.iteritems()]
+            heapq.heapify(self.expiry)
+
+    def __delitem__(self, _id):
+        self.pop(_id)
+
+    def add_persisted(self, _id, state, reaped, failures, lastseen, extra=None):
+        """Add an item from already decoded persisted fields, e.g. a database row."""
+        item = ReaperItem(state)
+        item.reaped, item.failures, item.lastseen, item.extra = reaped, failures, lastseen, extra
+        self[_id] = item
+
+    def pop(self, _id, *default):
+        # pylint: disable=missing-docstring,arguments-differ
+        item = super(ReaperState, self).pop(_id, *default)
+        if isinstance(item, ReaperItem):
+            item.owner = None
+            self.unreaped.discard(_id)
+            self.changed.discard(_id)
+            self.removed.add(_id)
+        return item
+
+    def update(self, *args, **kwargs):
+        # pylint: disable=missing-docstring
+        for _id, item in dict(*args, **kwargs).iteritems():
+            self[_id] = item
+
+    def item_changed(self, item):
+        """Keep the unreaped index in sync with an item and mark it for persisting."""
+        if item.reaped:
+            self.unreaped.discard(item.id_)
+        else:
+            self.unreaped.add(item.id_)
+        self.changed.add(item.id_)
+        self.removed.discard(item.id_)
+
+    def changes(self):
+        """Return and reset the sets of ids changed and removed since the last call."""
+        changed, removed = self.changed, self.removed
+        self.changed, self.removed = set(), set()
+        return changed, removed
+
+    def expired(self, cutoff):
+        """Return the ids of all items last seen before the cutoff datetime, in expiry order."""
+        cutoff = to_epoch(cutoff)
+        expired, expired_ids = [], set()
+        while self.expiry and self.expiry[0][0] < cutoff:
+            lastseen, _id = heapq.heappop(self.expiry)
+            item = self.get(_id)
+            if item is None or _id in expired_ids:  # purged, or a duplicate entry of a replaced item
+                continue
+            if item.lastseen == lastseen:
+                expired.append(_id)
+                expired_ids.add(_id)
+            elif item.lastseen > lastseen:  # seen again since, e.g. lastseen updated in place
+                heapq.heappush(self.expiry, (item.lastseen, _id))
+        return expired
+
 
 class Reaper(object):
 
     """Reaper class"""
 
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, id_, options):
         self.id_ = id_
-        self.state = {}
-        self.alive = True
+        self.state = ReaperState()
+        self.halted = threading.Event()
         self.opt = None
         self.opt_value = None
         self.upload_function = None
         self.unreaped_cnt = 0
 
         self.persistence_file = options.get('persistence_file')
-        self.sleeptime = options.get('sleeptime') or SLEEPTIME
+        self.state_db = statedb.StateDB(self.persistence_file) if statedb.is_sqlite_path(self.persistence_file) else None
+        self.scheduler = scheduler.PollScheduler(
+            options.get('sleeptime'), options.get('min_sleeptime'), options.get('max_sleeptime'), options.get('workinghours')
+        )
+        self.stability = scheduler.StabilityTracker(options.get('quiet_time'))
+        self.retry_policy = scheduler.RetryPolicy(options.get('retry_min'), options.get('retry_max'), options.get('abandon_after'))
+        self.retry_file = self.persistence_file + '.retry' if self.persistence_file else None
         self.graceperiod = datetime.timedelta(seconds=(options.get('graceperiod') or GRACEPERIOD))
         self.ignore_existing = options.get('ignore_existing') or False
-        self.tempdir = options.get('tempdir')
+        self.temp = tempmanager.TempManager(
+            options.get('tempdir'), options.get('fast_tempdir'),
+            options['fast_temp_limit'] * 1024 * 1024 if options.get('fast_temp_limit') is not None else None,
+            options['min_free'] * 1024 * 1024 if options.get('min_free') is not None else None,
+        )
         self.timezone = options.get('timezone')
-        self.working_hours = options.get('workinghours')
         self.oneshot = options.get('oneshot')
+        self.reap_jobs = max(options.get('reap_jobs') or 1, 1)
+        self.trace_writer = trace.TraceWriter(options['trace'], options.get('trace_profile')) if options.get('trace') else None
+        self.outbox = None
+        if options.get('outbox'):
+            outbox_limit = options['outbox_limit'] * 1024 * 1024 if options.get('outbox_limit') is not None else None
+            self.outbox = outbox.Outbox(options['outbox'], outbox_limit)
 
         if options['opt_in']:
             self.opt = 'in'
@@ -74,9 +277,14 @@ class Reaper(object):
             self.opt_value = options['opt_' + self.opt][1].lower()
         self.map_key = options['map_key']
 
-    def halt(self):
+    @property
+    def alive(self):
         # pylint: disable=missing-docstring
-        self.alive = False
+        return not self.halted.is_set()
+
+    def halt(self):
+        """Stop the run loop, waking it from sleep. Subclasses also cancel in-flight transfers."""
+        self.halted.set()
 
     def state_str(self, _id, state):
         # pylint: disable=missing-docstring
@@ -96,6 +304,30 @@ class Reaper(object):
         """
         pass
 
+    def after_run(self):
+        """
+        Operations for after the run loop.
+        """
+        pass
+
+    def before_reap_queue(self, reap_queue):
+        """
+        Operations for before the items of a reap queue are reaped, given the list of (_id, item) pairs.
+        """
+        pass
+
+    def after_reap_queue(self):
+        """
+        Operations after a reap queue has been processed or aborted.
+        """
+        pass
+
+    def after_purge(self, _id):
+        """
+        Operations after an item has been purged from the state at the end of its grace period.
+        """
+        pass
+
     def before_reap(self, _id):
         """
         Operations for before the series is reaped.
@@ -116,6 +348,21 @@ class Reaper(object):
         """
         pass
 
+    def size_hint(self, _id, item):
+        """
+        Expected temporary storage needed to reap the item in bytes, or None if unknown.
+        """
+        # pylint: disable=no-self-use,unused-argument
+        return None
+
+    def is_complete(self, _id, item):
+        """
+        Whether the instrument reports the item as complete, so it can be reaped before it has been quiet for
+        quiet_time seconds.
+        """
+        # pylint: disable=no-self-use,unused-argument
+        return False
+
     def __get_instrument_state(self):
         query_start = datetime.datetime.utcnow()
         state = self.instrument_query()
@@ -128,13 +375,15 @@ class Reaper(object):
     def __set_initial_state(self):
         # pylint: disable=missing-docstring
         log.warning('Initializing ' + self.__class__.__name__ + '...')
+        log.info('Temp storage %s', self.temp.usage())
         self.state = self.persistent_state
         if not self.state:
-            self.state = self.__get_instrument_state()
-            if self.state is None:
+            instrument_state = self.__get_instrument_state()
+            if instrument_state is None:
                 log.critical('Cannot continue without instrument state')
                 sys.exit(1)
             else:
+                self.state = ReaperState(instrument_state)
                 self.persistent_state = self.state
                 if self.ignore_existing:
                     log.warning('Ignoring     %d items currently on instrument', len(self.state))
@@ -142,87 +391,266 @@ class Reaper(object):
                         item['reaped'] = True
                 else:
                     log.warning('Discovered   %d items on instrument', len(self.state))
-            log.info('Sleeping     %.1fs', self.sleeptime)
-            time.sleep(self.sleeptime)
+            log.info('Sleeping     %.1fs', self.scheduler.min_sleeptime)
+            self.halted.wait(self.scheduler.min_sleeptime)
         else:
-            unreaped_cnt = len([v for v in self.state.itervalues() if not v['reaped']])
+            unreaped_cnt = len(self.state.unreaped)
             log.warning('Loaded %d items from persistence file, %d not reaped', len(self.state), unreaped_cnt)
             log.warning('*** Delete persistence file to reset ***')
 
     def __build_reap_queue(self, new_state):
         reap_queue = []
+        monitoring_cnt = backoff_cnt = 0
+        now = time.time()
         for _id, new_item in new_state.iteritems():
             item = self.state.get(_id)
+            changed = True
             if item:
                 new_item['reaped'] = item['reaped']
                 new_item['failures'] = item['failures']
-                if not item['reaped'] and new_item['state'] == item['state']:
-                    reap_queue.append((_id, new_item))  # TODO avoid weird tuples, maybe include id in item
-                elif new_item['state'] != item['state']:
+                new_item.update({key: item[key] for key in RETRY_KEYS if key in item})
+                changed = new_item['state'] != item['state']
+                if changed:
                     new_item['reaped'] = False
+                    new_item['failures'] = 0
+                    for key in RETRY_KEYS:  # new data, retry as soon as it is stable, with fresh retries
+                        new_item.pop(key)
+                    self.stability.changed(_id, now)
                     log.info('Monitoring   ' + self.state_str(_id, new_item['state']))
             else:
+                self.stability.changed(_id, now)
                 log.info('Discovered   ' + self.state_str(_id, new_item['state']))
-        return reap_queue
+            if new_item['reaped']:
+                continue
+            if new_item.get('retry_at', 0) > now:
+                backoff_cnt += 1
+                continue
+            if self.is_complete(_id, new_item):
+                log.info('Complete     ' + self.state_str(_id, new_item['state']))
+                reap_queue.append((_id, new_item))  # TODO avoid weird tuples, maybe include id in item
+            elif not changed and self.stability.is_quiet(_id, now):
+                reap_queue.append((_id, new_item))
+            else:
+                monitoring_cnt += 1
+        if backoff_cnt:
+            log.info('Backing off  %d failed items', backoff_cnt)
+        return reap_queue, monitoring_cnt
 
     def __prune_stale_state(self, reap_start):
-        for _id in [_id for _id, item in self.state.iteritems() if item['lastseen'] + self.graceperiod < reap_start]:
+        for _id in self.state.expired(reap_start - self.graceperiod):
             log.info('Purging      %s', _id)
             self.state.pop(_id)
+            self.stability.forget(_id)
+            self.after_purge(_id)
 
     def __process_reap_queue(self, reap_queue):
+        """Reap up to reap_jobs items at once and apply the outcomes in the order they finish."""
+        self.before_reap_queue(reap_queue)
+        try:
+            self.__reap_queue_items(reap_queue)
+        finally:
+            self.after_reap_queue()
+
+    def __reap_queue_items(self, reap_queue):
+        # pylint: disable=missing-docstring
         reap_queue_len = len(reap_queue)
-        for i, _id_item in enumerate(reap_queue):
-            if not self.in_working_hours:
-                log.warning('Aborting     reap-run (off-duty)')
+        pending = collections.deque(reap_queue)
+        outcomes = Queue.Queue()
+        in_flight = 0
+        deferred = set()
+        while pending or in_flight:
+            while pending and in_flight < self.reap_jobs and self.alive:
+                if not self.in_working_hours:
+                    log.warning('Aborting     reap-run (off-duty)')
+                    pending.clear()
+                    break
+                index = self.__first_fitting(pending, deferred)
+                if index is None:
+                    if not in_flight:  # nothing will free up space during this run
+                        log.warning('Deferring    %d items to the next reap-run (low temp space: %s)', len(pending), self.temp.usage())
+                        pending.clear()
+                    break
+                if self.outbox is not None and self.outbox.full:
+                    if not in_flight:
+                        log.warning('Aborting     reap-run (outbox full: %s)', self.outbox.usage())
+                        pending.clear()
+                    break
+                _id, item = pending[index]
+                del pending[index]
+                log.warning('Reap queue   item %d of %d', reap_queue_len - len(pending), reap_queue_len)
+                worker = threading.Thread(target=self.__reap_worker, args=(_id, item, outcomes))
+                worker.daemon = True
+                worker.start()
+                in_flight += 1
+            if not in_flight:
                 break
-            _id, item = _id_item
-            log.warning('Reap queue   item %d of %d', i + 1, reap_queue_len)
-            with tempfile.TemporaryDirectory(dir=self.tempdir) as tempdir:
-                self.before_reap(_id)
-                item['reaped'], metadata_map = self.reap(_id, item, tempdir)  # returns True, False, None
-                if item['reaped']:
-                    item['failures'] = 0
-                    item['reaped'] = upload.upload_many(metadata_map, self.upload_function)
-                elif item['reaped'] is None:  # mark skipped or discarded items as reaped
-                    item['reaped'] = True
-                else:
-                    item['failures'] += 1
-                    log.error('Failure      %s (%d failures)', _id, item['failures'])
-                    if item['failures'] > 9:
-                        item['reaped'] = True
-                        item['abandoned'] = True
-                        log.error('Abandoning   ' + self.state_str(_id, item['state']))
-                if item['reaped']:
-                    self.after_reap_success(_id)
-                self.after_reap(_id)
+            try:
+                _id, item, outcome, exc_info = outcomes.get(timeout=1)  # a timeout keeps the main thread responsive to signals
+            except Queue.Empty:
+                continue
+            in_flight -= 1
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.__apply_outcome(_id, item, outcome)
             self.persistent_state = self.state
 
+    def __first_fitting(self, pending, deferred):
+        """
+        Return the index of the first pending item that fits into the temp space, or None.
+
+        Items that don't fit are skipped rather than blocking the ones behind them, and logged once per reap-run.
+        """
+        for index, (_id, item) in enumerate(pending):
+            if self.temp.has_space(self.size_hint(_id, item)):
+                return index
+            if _id not in deferred:
+                deferred.add(_id)
+                log.warning('Deferring    %s (%s needed, low temp space: %s)', _id, util.hrsize(self.size_hint(_id, item)), self.temp.usage())
+        return None
+
+    def __reap_worker(self, _id, item, outcomes):
+        # pylint: disable=missing-docstring
+        outcome = exc_info = None
+        tracer = self.trace_writer.trace(_id) if self.trace_writer is not None else None
+        try:
+            with trace.activate(tracer):
+                outcome = self.__reap_item(_id, item)
+        except BaseException:  # pylint: disable=broad-except
+            exc_info = sys.exc_info()
+        if tracer is not None:
+            self.trace_writer.write(tracer, trace_result(outcome, exc_info))
+        outcomes.put((_id, item, outcome, exc_info))
+
+    def __reap_item(self, _id, item):
+        """
+        Reap and upload a single item in a reap worker thread.
+
+        The item is only read here; its new reaped flag, failure count and abandonment are returned and applied to the
+        state by the main thread.
+        """
+        failures, abandoned, handed_off = item['failures'], False, False
+        with self.temp.directory(self.size_hint(_id, item)) as tempdir:
+            self.before_reap(_id)
+            with trace.span('reap'):
+                reaped, metadata_map = self.reap(_id, item, tempdir)  # returns True, False, None
+            if reaped:
+                failures = 0
+                if self.outbox is not None:
+                    reaped = handed_off = self.outbox.put(_id, metadata_map)
+                else:
+                    reaped = upload.upload_many(metadata_map, self.upload_function)
+            elif reaped is None:  # mark skipped or discarded items as reaped
+                reaped = True
+            elif not self.alive:
+                log.warning('Cancelled    %s', _id)
+                return None
+            else:
+                failures += 1
+                log.error('Failure      %s (%d failures)', _id, failures)
+                if self.retry_policy.should_abandon(item.get('first_failure'), time.time()):
+                    reaped = abandoned = True
+                    log.error('Abandoning   ' + self.state_str(_id, item['state']))
+            if reaped:
+                self.after_reap_success(_id)
+            self.after_reap(_id)
+        return reaped, failures, abandoned, handed_off
+
+    def __apply_outcome(self, _id, item, outcome):
+        # pylint: disable=missing-docstring
+        if outcome is None:  # cancelled on halt, retry after restart
+            return
+        item['reaped'], item['failures'], abandoned, handed_off = outcome
+        if abandoned:
+            item['abandoned'] = True
+        if handed_off:
+            item['handed_off'] = True
+        if item['reaped']:
+            self.stability.forget(_id)
+            item.pop('retry_at')
+            if not abandoned:
+                item.pop('first_failure')
+        elif item['failures']:
+            now = time.time()
+            if item.get('first_failure') is None:
+                item['first_failure'] = now
+            item['retry_at'] = self.retry_policy.next_attempt(item['failures'], now)
+            log.warning('Retrying     %s in %.0fs', _id, item['retry_at'] - now)
+
+    def force_retry(self, ids):
+        """
+        Make items due for reaping again, regardless of backoff, abandonment or earlier success.
+
+        RETRY_ALL selects all items that failed or were abandoned. Items are retried once their state is stable.
+        """
+        if RETRY_ALL in ids:
+            ids = [_id for _id, item in self.state.iteritems() if item['failures'] or item.get('abandoned')]
+        for _id in ids:
+            item = self.state.get(_id)
+            if item is None:
+                log.warning('Not retrying %s (unknown item)', _id)
+                continue
+            log.warning('Retrying     %s (forced)', _id)
+            item['reaped'] = False
+            item['failures'] = 0
+            for key in RETRY_KEYS:
+                item.pop(key)
+
+    def __read_retry_requests(self):
+        """Apply force-retry requests appended to the retry file, e.g. by bin/reaper_retry, one item id per line."""
+        if not self.retry_file or not os.path.exists(self.retry_file):
+            return
+        processing_path = self.retry_file + '.processing'
+        try:
+            os.rename(self.retry_file, processing_path)
+            with open(processing_path) as fd:
+                ids = [line.strip() for line in fd if line.strip()]
+            os.remove(processing_path)
+        except EnvironmentError as ex:
+            log.error('Reading      %s failed: %s', self.retry_file, ex)
+            return
+        self.force_retry(ids)
+
     def run(self):
         # pylint: disable=missing-docstring
         self.before_run()
+        if self.outbox is not None:
+            self.outbox.start(self.upload_function)
+        try:
+            self.__run()
+        finally:
+            self.after_run()
+            if self.outbox is not None:
+                self.outbox.stop()
+            self.temp.close()
+
+    def __run(self):
+        # pylint: disable=missing-docstring
         self.__set_initial_state()
         while self.alive:
             if not self.in_working_hours:
-                log.info('Sleeping     %.0fs (off-duty)', OFFDUTY_SLEEPTIME)
-                time.sleep(OFFDUTY_SLEEPTIME)
+                sleeptime = self.scheduler.offduty_sleeptime()
+                log.info('Sleeping     %.0fs (off-duty)', sleeptime)
+                self.halted.wait(sleeptime)
                 continue
+            self.__read_retry_requests()
             new_state = self.__get_instrument_state()
             reap_start = datetime.datetime.utcnow()
+            reap_queue, monitoring_cnt = [], 0
             if new_state is not None:
-                reap_queue = self.__build_reap_queue(new_state)
+                reap_queue, monitoring_cnt = self.__build_reap_queue(new_state)
                 self.state.update(new_state)
                 self.__prune_stale_state(reap_start)
                 self.persistent_state = self.state
                 self.__process_reap_queue(reap_queue)
-                self.unreaped_cnt = len([v for v in self.state.itervalues() if not v['reaped']])
+                self.unreaped_cnt = len(self.state.unreaped)
                 log.warning('Monitoring   %d items, %d not reaped', len(self.state), self.unreaped_cnt)
             if self.oneshot:
                 break
-            sleeptime = self.sleeptime - (datetime.datetime.utcnow() - reap_start).total_seconds()
+            sleeptime = self.scheduler.next_sleeptime(monitoring_cnt, len(reap_queue))
+            sleeptime -= (datetime.datetime.utcnow() - reap_start).total_seconds()
             if sleeptime > 0:
                 log.info('Sleeping     %.1fs', sleeptime)
-                time.sleep(sleeptime)
+                self.halted.wait(sleeptime)
 
     def is_desired_item(self, opt):
         # pylint: disable=missing-docstring
@@ -237,39 +665,64 @@ class Reaper(object):
     @property
     def in_working_hours(self):
         # pylint: disable=missing-docstring
-        if not self.working_hours:
-            return True
-        local_now = datetime.datetime.now().time()
-        if self.working_hours[0] < self.working_hours[1] and not self.working_hours[0] < local_now < self.working_hours[1]:
-            return False
-        if self.working_hours[0] > self.working_hours[1] and self.working_hours[1] < local_now < self.working_hours[0]:
-            return False
-        return True
+        return self.scheduler.in_working_hours
 
     @property
     def persistent_state(self):
         # pylint: disable=missing-docstring
-        return util.read_state_file(self.persistence_file)
+        if self.state_db is not None:
+            return self.state_db.load(ReaperState())
+        return ReaperState(util.read_state_file(self.persistence_file))
 
     @persistent_state.setter
     def persistent_state(self, state):
         # pylint: disable=missing-docstring
         log.debug('Persisting   instrument state')
-        util.write_state_file(self.persistence_file, state)
+        if self.state_db is not None:
+            self.state_db.save(state)
+        else:
+            state.changes()
+            util.write_state_file(self.persistence_file, state)
+
+
+def trace_result(outcome, exc_info):
+    # pylint: disable=missing-docstring
+    if exc_info is not None:
+        return 'error'
+    if outcome is None:
+        return 'cancelled'
+    reaped, _, abandoned, handed_off = outcome
+    if handed_off:
+        return 'handed off'
+    return 'abandoned' if abandoned else 'reaped' if reaped else 'failed'
 
 
 def main(cls, arg_parser_update=None):
     # pylint: disable=missing-docstring
     arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('persistence_file', help='path to persistence file')
+    arg_parser.add_argument('persistence_file', help='path to persistence file (.db, .sqlite or .sqlite3 for the SQLite backend, JSON otherwise)')
     arg_parser.add_argument('-s', '--sleeptime', type=int, help='time to sleep before checking for new data [60s]')
+    arg_parser.add_argument('--min-sleeptime', type=int, help='time to sleep while new data is changing [10s]')
+    arg_parser.add_argument('--max-sleeptime', type=int, help='longest time to sleep after repeatedly finding no new data [300s]')
+    arg_parser.add_argument('--reap-jobs', type=int, help='number of items to reap and upload concurrently [1]')
+    arg_parser.add_argument('--retry-min', type=int, help='time to wait before retrying an item after its first failure, doubling per failure [60s]')
+    arg_parser.add_argument('--retry-max', type=int, help='longest time to wait before retrying a failed item [3600s]')
+    arg_parser.add_argument('--abandon-after', type=int, help='time after the first failure of an item to stop retrying it [24h]')
+    arg_parser.add_argument('--quiet-time', type=int, help='time new data must remain unchanged before it is reaped [30s]')
     arg_parser.add_argument('-g', '--graceperiod', type=int, help='time to keep vanished data alive [24h]')
     arg_parser.add_argument('-t', '--tempdir', help='directory to use for temporary files')
+    arg_parser.add_argument('--fast-tempdir', help='directory on fast storage (e.g. tmpfs) to use for temporary files of small items')
+    arg_parser.add_argument('--fast-temp-limit', type=int, help='largest expected item size for --fast-tempdir in MB [512]')
+    arg_parser.add_argument('--min-free', type=int, help='free space to keep in --tempdir, deferring items that would go below it, in MB [unlimited]')
+    arg_parser.add_argument('--outbox', help='directory to hand packaged items over to, uploading them in the background')
+    arg_parser.add_argument('--outbox-limit', type=int, help='outbox size above which reaping pauses, in MB [10240]')
     arg_parser.add_argument('-z', '--timezone', help='instrument timezone [system timezone]')
     arg_parser.add_argument('-x', '--ignore_existing', action='store_true', help='ignore existing data')
     arg_parser.add_argument('-l', '--loglevel', default='warning', help='log level [WARNING]')
     arg_parser.add_argument('-i', '--insecure', action='store_true', help='do not verify server SSL certificates')
     arg_parser.add_argument('-k', '--workinghours', nargs=2, type=int, help='working hours in 24hr time [0 24]')
+    arg_parser.add_argument('--trace', help='append a JSON record with the timing of each reap stage per item to this file')
+    arg_parser.add_argument('--trace-profile', type=float, help='with --trace, save cProfile stats of stages taking longer than this [off]')
     arg_parser.add_argument('-o', '--oneshot', action='store_true', help='break out of runloop after one iteration (for testing)')
 
     auth_group = arg_parser.add_mutually_exclusive_group()
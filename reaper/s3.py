@@ -0,0 +1,203 @@
+"""SciTran Reaper S3 client with Signature Version 4 and parallel multipart upload"""
+
+import os
+import hmac
+import time
+import Queue
+import urllib
+import hashlib
+import logging
+import datetime
+import urlparse
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from . import util
+
+requests = util.LazyModule('requests')  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)
+
+REGION = 'us-east-1'
+PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+CONCURRENCY = 4
+PART_ATTEMPTS = 3
+RETRY_DELAY = 2
+
+
+class S3Error(Exception):
+    """An S3 request failed"""
+    pass
+
+
+def quote(value, safe='-_.~'):
+    # pylint: disable=missing-docstring
+    return urllib.quote(value.encode('utf-8') if isinstance(value, unicode) else value, safe)
+
+
+def canonical_query(params):
+    # pylint: disable=missing-docstring
+    return '&'.join('%s=%s' % (quote(key), quote(value)) for key, value in sorted(params.iteritems()))
+
+
+def xml_text(content, tag):
+    """Return the text of the first element named tag in an S3 XML response, regardless of namespace, or None."""
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return None
+    return next((element.text for element in root.iter() if element.tag.rpartition('}')[2] == tag), None)
+
+
+class S3Client(object):
+
+    """
+    S3Client sends requests for the objects of one bucket, signed with AWS Signature Version 4.
+
+    Path-style addressing is used, so any S3-compatible endpoint works, e.g. a local stand-in. Request bodies are
+    strings, so memory use is bounded by the largest part in flight.
+    """
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region=None, verify=True, pool_size=CONCURRENCY):
+        parsed = urlparse.urlparse(endpoint)
+        default_port = {'http': 80, 'https': 443}.get(parsed.scheme)
+        self.endpoint = '%s://%s' % (parsed.scheme, parsed.netloc)
+        self.host = parsed.hostname + (':%d' % parsed.port if parsed.port and parsed.port != default_port else '')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region or REGION
+        self.signing_keys = {}
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, key, params=None, headers=None, body=''):
+        """Send a signed request for the object key and return the response, raising S3Error unless it succeeded."""
+        path = '/%s/%s' % (quote(self.bucket), quote(key, safe='-_.~/'))
+        params = params or {}
+        headers = dict(headers or {}, host=self.host)
+        headers['x-amz-content-sha256'] = hashlib.sha256(body).hexdigest()
+        headers['x-amz-date'] = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        headers['Authorization'] = self.authorization(method, path, params, headers)
+        url = self.endpoint + path + ('?' + canonical_query(params) if params else '')
+        try:
+            r = self.session.request(method, url, headers=headers, data=body)
+        except requests.exceptions.RequestException as ex:
+            raise S3Error('%s %s: %s' % (method, key, ex))
+        if not r.ok:
+            raise S3Error('%s %s: %s %s' % (method, key, r.status_code, xml_text(r.content, 'Code') or r.reason))
+        return r
+
+    def authorization(self, method, path, params, headers):
+        """Return the Signature Version 4 Authorization header for a request, signing all of its headers."""
+        amz_date = headers['x-amz-date']
+        scope = '%s/%s/s3/aws4_request' % (amz_date[:8], self.region)
+        headers = sorted((name.lower(), ' '.join(str(value).split())) for name, value in headers.iteritems())
+        signed_headers = ';'.join(name for name, _ in headers)
+        canonical_request = '\n'.join([
+            method, path, canonical_query(params), ''.join('%s:%s\n' % header for header in headers), signed_headers,
+            dict(headers)['x-amz-content-sha256'],
+        ])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request).hexdigest()])
+        signature = hmac.new(self.__signing_key(amz_date[:8]), string_to_sign, hashlib.sha256).hexdigest()
+        return 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (self.access_key, scope, signed_headers, signature)
+
+    def __signing_key(self, datestamp):
+        # pylint: disable=missing-docstring
+        if datestamp not in self.signing_keys:
+            signing_key = 'AWS4' + self.secret_key
+            for value in (datestamp, self.region, 's3', 'aws4_request'):
+                signing_key = hmac.new(signing_key, value, hashlib.sha256).digest()
+            self.signing_keys = {datestamp: signing_key}
+        return self.signing_keys[datestamp]
+
+    def upload_file(self, key, filepath, part_size=None, concurrency=None, headers=None):
+        """
+        Store a file as the object key.
+
+        Files larger than part_size are sent as a multipart upload, concurrency parts at a time, each read from disk
+        only when it is sent. A failed part is retried PART_ATTEMPTS times in all; if it still fails, the multipart
+        upload is aborted and S3Error raised.
+        """
+        part_size = part_size or PART_SIZE
+        size = os.path.getsize(filepath)
+        if size <= part_size:
+            with open(filepath, 'rb') as fd:
+                self.request('PUT', key, headers=headers, body=fd.read())
+            return
+        part_size = max(part_size, MIN_PART_SIZE, -(-size // MAX_PARTS))
+        upload_id = xml_text(self.request('POST', key, params={'uploads': ''}, headers=headers).content, 'UploadId')
+        if not upload_id:
+            raise S3Error('POST %s: no UploadId in response' % key)
+        try:
+            etags = self.__upload_parts(key, upload_id, filepath, size, part_size, concurrency or CONCURRENCY)
+            body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+                '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (part_no, etag) for part_no, etag in etags)
+            error_code = xml_text(self.request('POST', key, params={'uploadId': upload_id}, body=body).content, 'Code')
+            if error_code is not None:  # completion errors may come with 200 OK
+                raise S3Error('POST %s: completing multipart upload failed: %s' % (key, error_code))
+        except BaseException:
+            try:
+                self.request('DELETE', key, params={'uploadId': upload_id})
+            except S3Error as ex:
+                log.warning('Aborting     multipart upload of %s failed: %s', key, ex)
+            raise
+
+    def __upload_parts(self, key, upload_id, filepath, size, part_size, concurrency):
+        """Upload all parts of a file with concurrency threads and return the sorted (part number, ETag) pairs."""
+        parts = Queue.Queue()
+        part_cnt = -(-size // part_size)
+        for part_no in xrange(1, part_cnt + 1):
+            parts.put(part_no)
+        etags, errors = {}, []
+        failed = threading.Event()
+
+        def upload_parts():
+            # pylint: disable=missing-docstring
+            try:
+                upload_parts_from(open(filepath, 'rb'))
+            except Exception as ex:  # pylint: disable=broad-except
+                errors.append(S3Error('PUT %s: %s' % (key, ex)) if not isinstance(ex, S3Error) else ex)
+                failed.set()
+
+        def upload_parts_from(fd):
+            # pylint: disable=missing-docstring
+            with fd:
+                while not failed.is_set():
+                    try:
+                        part_no = parts.get_nowait()
+                    except Queue.Empty:
+                        return
+                    fd.seek((part_no - 1) * part_size)
+                    body = fd.read(part_size)
+                    for attempt in xrange(1, PART_ATTEMPTS + 1):
+                        try:
+                            r = self.request('PUT', key, params={'partNumber': str(part_no), 'uploadId': upload_id}, body=body)
+                            if not r.headers.get('ETag'):
+                                raise S3Error('PUT %s: no ETag for part %d' % (key, part_no))
+                            etags[part_no] = r.headers['ETag']
+                            break
+                        except S3Error as ex:
+                            if attempt == PART_ATTEMPTS or failed.is_set():
+                                raise
+                            log.warning('Retrying     part %d, %s', part_no, ex)
+                            time.sleep(RETRY_DELAY * attempt)
+
+        threads = [threading.Thread(target=upload_parts) for _ in xrange(min(concurrency, parts.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if len(etags) != part_cnt:
+            raise S3Error('PUT %s: %d of %d parts uploaded' % (key, len(etags), part_cnt))
+        return sorted(etags.iteritems())
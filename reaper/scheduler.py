@@ -0,0 +1,131 @@
+"""SciTran Reaper adaptive poll scheduling"""
+
+import random
+import datetime
+
+SLEEPTIME = 60
+MIN_SLEEPTIME = 10
+MAX_SLEEPTIME = 300
+BACKOFF_FACTOR = 2
+QUIETTIME = 30
+RETRY_MIN = 60
+RETRY_MAX = 3600
+ABANDON_AFTER = 86400
+
+
+class PollScheduler(object):
+
+    """
+    PollScheduler decides how long a reaper sleeps between instrument queries.
+
+    While unreaped items are waiting to become stable, the instrument is polled every min_sleeptime seconds, so that
+    they are reaped soon after acquisition ends. After a poll that only reaped
+    items, the regular sleeptime applies. Every further consecutive idle poll doubles the interval, up to max_sleeptime.
+    Outside of working hours, the scheduler sleeps until the next working period starts.
+    """
+
+    def __init__(self, sleeptime=None, min_sleeptime=None, max_sleeptime=None, working_hours=None):
+        self.sleeptime = sleeptime or SLEEPTIME
+        self.min_sleeptime = min(min_sleeptime or MIN_SLEEPTIME, self.sleeptime)
+        self.max_sleeptime = max(max_sleeptime or MAX_SLEEPTIME, self.sleeptime)
+        self.working_hours = working_hours
+        self.idle_cnt = 0
+
+    @property
+    def in_working_hours(self):
+        # pylint: disable=missing-docstring
+        if not self.working_hours:
+            return True
+        local_now = datetime.datetime.now().time()
+        if self.working_hours[0] < self.working_hours[1] and not self.working_hours[0] < local_now < self.working_hours[1]:
+            return False
+        if self.working_hours[0] > self.working_hours[1] and self.working_hours[1] < local_now < self.working_hours[0]:
+            return False
+        return True
+
+    def offduty_sleeptime(self):
+        """Return the number of seconds until working hours start."""
+        local_now = datetime.datetime.now()
+        start = datetime.datetime.combine(local_now.date(), self.working_hours[0])
+        if start <= local_now:
+            start += datetime.timedelta(days=1)
+        self.idle_cnt = 0
+        return max((start - local_now).total_seconds(), 1)
+
+    def next_sleeptime(self, monitoring_cnt, reaped_cnt):
+        """
+        Return the interval until the next query, given the outcome of the current one.
+
+        Parameters
+        ----------
+        monitoring_cnt : int
+            number of unreaped items waiting to become stable
+        reaped_cnt : int
+            number of items in the reap queue of the current query
+
+        Returns
+        -------
+        sleeptime : float
+            seconds from the start of the current query to the next one
+
+        """
+        if monitoring_cnt:
+            self.idle_cnt = 0
+            return self.min_sleeptime
+        if reaped_cnt:
+            self.idle_cnt = 0
+            return self.sleeptime
+        self.idle_cnt += 1
+        return min(self.sleeptime * BACKOFF_FACTOR ** min(self.idle_cnt - 1, 16), self.max_sleeptime)
+
+
+class StabilityTracker(object):
+
+    """
+    StabilityTracker records when the state of each unreaped item last changed.
+
+    An item is considered stable once its state has not changed for quiet_time seconds, independent of how often the
+    instrument is polled in the meantime.
+    """
+
+    def __init__(self, quiet_time=None):
+        self.quiet_time = QUIETTIME if quiet_time is None else quiet_time
+        self.changed_at = {}
+
+    def changed(self, _id, now):
+        """Record that the state of an item changed or first appeared at time now."""
+        self.changed_at[_id] = now
+
+    def is_quiet(self, _id, now):
+        """Return True if the state of an item has not changed for quiet_time seconds."""
+        return now - self.changed_at.setdefault(_id, now) >= self.quiet_time
+
+    def forget(self, _id):
+        # pylint: disable=missing-docstring
+        self.changed_at.pop(_id, None)
+
+
+class RetryPolicy(object):
+
+    """
+    RetryPolicy spaces out the reap attempts of failing items and decides when to give up on them.
+
+    After the n-th consecutive failure, an item is retried after a delay of retry_min * 2^(n-1) seconds, capped at
+    retry_max. The actual delay is drawn between half and all of that, so items failing together do not retry in
+    lockstep.
+    An item is abandoned once its first failure is abandon_after seconds in the past.
+    """
+
+    def __init__(self, retry_min=None, retry_max=None, abandon_after=None):
+        self.retry_min = RETRY_MIN if retry_min is None else retry_min
+        self.retry_max = max(RETRY_MAX if retry_max is None else retry_max, self.retry_min)
+        self.abandon_after = ABANDON_AFTER if abandon_after is None else abandon_after
+
+    def next_attempt(self, failures, now):
+        """Return the earliest time to retry an item after its failures-th consecutive failure at time now."""
+        delay = min(self.retry_min * BACKOFF_FACTOR ** min(failures - 1, 16), self.retry_max)
+        return now + delay * random.uniform(0.5, 1.0)
+
+    def should_abandon(self, first_failure, now):
+        """Return True if an item failing since first_failure should no longer be retried at time now."""
+        return first_failure is not None and now - first_failure >= self.abandon_after
@@ -0,0 +1,159 @@
+"""
+SCP is a module that wraps the storescp command, which is part of DCMTK.
+
+A single long-lived StorageSCP receives the C-STORE sub-operations of many concurrent C-MOVEs on one port. Incoming
+instances are routed into per-series spool directories keyed by SeriesInstanceUID, and waiters are notified as
+instances arrive, so an SCU can tell when all sub-operations of its move request have landed. A route registered for a
+StudyInstanceUID only counts the instances of that study, so a study-level move can wait for all of them.
+"""
+
+import os
+import time
+import shlex
+import shutil
+import signal
+import logging
+import threading
+import subprocess
+
+from . import dcm
+from . import scu
+
+log = logging.getLogger(__name__)
+
+RECEIVED_MARKER = 'RECEIVED '
+WAIT_TIMEOUT = 60
+FORK_OPTION = '--fork'  # one process per association, so that concurrent moves are received concurrently
+
+
+class _Route(object):
+
+    """Spool directory and arrival count for one SeriesInstanceUID, or only the count for one StudyInstanceUID"""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, dest_path):
+        self.dest_path = dest_path
+        self.received = 0
+
+
+class StorageSCP(object):
+
+    """
+    StorageSCP runs storescp in the background and routes received instances by SeriesInstanceUID.
+
+    Instantiated with the local return port and AE title that the remote sends C-STORE requests to, and a spool
+    directory on the same filesystem as the per-series destinations. A transfer_syntax from scu.TRANSFER_SYNTAX_OPTIONS
+    is preferred when accepting associations.
+    """
+
+    def __init__(self, port, aet, spool_path, transfer_syntax=None):
+        self.port = port
+        self.aet = aet
+        self.transfer_syntax_option = scu.TRANSFER_SYNTAX_OPTIONS[transfer_syntax] if transfer_syntax else ''
+        self.incoming_path = os.path.join(spool_path, 'incoming')
+        self.routes = {}
+        self.cond = threading.Condition()
+        self.process = None
+        self.router = None
+        self.stopping = False
+        if not os.path.isdir(self.incoming_path):
+            os.makedirs(self.incoming_path)
+
+    def start(self):
+        """Launch storescp and the routing thread."""
+        cmd = 'storescp -v %s --aetitle %s --output-directory %s --exec-on-reception "echo %s#p/#f" --exec-sync %s %s' % (
+            FORK_OPTION, self.aet, self.incoming_path, RECEIVED_MARKER, self.transfer_syntax_option, str(self.port))
+        log.debug(cmd)
+        self.process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        self.router = threading.Thread(target=self.__route_received)
+        self.router.daemon = True
+        self.router.start()
+        log.info('Listening    for C-STORE as %s on port %s', self.aet, self.port)
+
+    def stop(self):
+        """Terminate storescp, including the processes of associations in progress, and wait for the routing thread to drain."""
+        self.stopping = True
+        if self.process is not None and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            self.process.wait()
+        if self.router is not None:
+            self.router.join()
+        with self.cond:
+            self.cond.notify_all()
+
+    @property
+    def alive(self):
+        # pylint: disable=missing-docstring
+        return self.process is not None and self.process.poll() is None
+
+    def register(self, uid, dest_path=None):
+        """Route instances of series uid into dest_path until unregistered, or count instances of study uid if no path is given."""
+        with self.cond:
+            self.routes[uid] = _Route(dest_path)
+
+    def unregister(self, uid):
+        """Stop routing uid and return the number of instances received for it."""
+        with self.cond:
+            route = self.routes.pop(uid, None)
+        return route.received if route else 0
+
+    def received(self, series_uid):
+        # pylint: disable=missing-docstring
+        with self.cond:
+            route = self.routes.get(series_uid)
+            return route.received if route else 0
+
+    def wait(self, uid, count, timeout=WAIT_TIMEOUT):
+        """Block until count instances of uid have been received, storescp dies or no instance arrives for timeout seconds."""
+        with self.cond:
+            route = self.routes[uid]
+            received, deadline = route.received, time.time() + timeout
+            while route.received < count and time.time() < deadline and self.alive:
+                self.cond.wait(1)
+                if route.received > received:
+                    received, deadline = route.received, time.time() + timeout
+            if route.received < count:
+                log.warning('Timeout      %s, received %d of %d images', uid, route.received, count)
+            return route.received
+
+    def __route_received(self):
+        # pylint: disable=missing-docstring
+        for line in iter(self.process.stdout.readline, ''):
+            if not line.startswith(RECEIVED_MARKER):
+                log.debug(line.rstrip())
+                continue
+            filepath = line[len(RECEIVED_MARKER):].strip()
+            try:
+                raw = dcm.DicomFile(filepath).raw
+                series_uid, study_uid = raw.SeriesInstanceUID, raw.StudyInstanceUID
+            except (dcm.DicomFileError, AttributeError, IOError):
+                log.warning('Discarding   unparsable instance %s', os.path.basename(filepath))
+                self.__discard(filepath)
+                continue
+            with self.cond:
+                route, study_route = self.routes.get(series_uid), self.routes.get(study_uid)
+                if route is None or route.dest_path is None:
+                    if study_route is None:
+                        log.warning('Discarding   unrequested instance of %s', series_uid)
+                    self.__discard(filepath)
+                else:
+                    shutil.move(filepath, os.path.join(route.dest_path, os.path.basename(filepath)))  # renames unless on another tier
+                    route.received += 1
+                if study_route is not None:
+                    study_route.received += 1
+                self.cond.notify_all()
+        status = self.process.wait()
+        if not self.stopping:
+            log.error('storescp exited unexpectedly with status %s', status)
+
+    @staticmethod
+    def __discard(filepath):
+        # pylint: disable=missing-docstring
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
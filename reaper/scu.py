@@ -14,9 +14,13 @@ the find() or move() methods of an SCU object.
 import os
 import re
 import shlex
+import signal
 import logging
+import threading
 import subprocess
 
+from . import dcm
+
 log = logging.getLogger(__name__)
 
 RESPONSE_RE = re.compile(
@@ -31,6 +35,19 @@ DICOM_CV_RE = re.compile(
     r'(?P<type>\w{2}) (?P<value>.+)#[ ]*(?P<length>\d+),[ ]*(?P<n_elems>\d+) (?P<label>\w+)\n'
 )
 
+COMPLETED_RE = re.compile(r'Number of Completed Sub-operations\s*:\s*(?P<count>\d+)')
+
+# movescu/storescp options for the preferred transfer syntax of incoming C-STORE associations. The remote may still
+# choose uncompressed little endian, which is always proposed as well. Lossy syntaxes are deliberately not offered.
+TRANSFER_SYNTAX_OPTIONS = {
+    'uncompressed': '--prefer-uncompr',
+    'deflated': '--prefer-deflated',
+    'rle': '--prefer-rle',
+    'jpeg-lossless': '--prefer-lossless',
+    'jpeg-ls-lossless': '--prefer-jls-lossless',
+    'jpeg2000-lossless': '--prefer-j2k-lossless',
+}
+
 QUERY_TEMPLATE = {
     'StudyInstanceUID': '',
     'StudyDate': '',
@@ -56,15 +73,23 @@ class SCU(object):
     SCU stores information required to communicate with the scanner during calls to find() and move().
 
     Instantiated with the host, port, and aet of the scanner, as well as the aec of the calling machine. Incoming port
-    is optional (default=port).
+    is optional (default=port). If a shared StorageSCP receiver is given, moves don't bind the return port themselves,
+    so many of them can be in flight at once. Running findscu and movescu processes can be cancelled with terminate().
+    A transfer_syntax from TRANSFER_SYNTAX_OPTIONS is preferred for the instances received by moves.
     """
 
-    def __init__(self, host, port, return_port, aet, aec):
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, host, port, return_port, aet, aec, receiver=None, transfer_syntax=None):
         self.host = host
         self.port = port
         self.return_port = return_port
         self.aet = aet
         self.aec = aec
+        self.receiver = receiver
+        self.transfer_syntax_option = TRANSFER_SYNTAX_OPTIONS[transfer_syntax] if transfer_syntax else ''
+        self.processes = set()
+        self.lock = threading.Lock()
 
     def find(self, query):
         """ Construct a findscu query. Return a list of Response objects. """
@@ -72,7 +97,7 @@ class SCU(object):
         log.debug(cmd)
         output = ''
         try:
-            output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT)
+            output = self.__check_output(cmd)
         except subprocess.CalledProcessError as ex:
             log.debug('%s: %s', type(ex).__name__, ex)
             if output:
@@ -86,11 +111,15 @@ class SCU(object):
 
     def move(self, query, dest_path='.'):
         """Construct a movescu query. Return the count of images successfully transferred."""
-        cmd = 'movescu -v -od %s --port %s %s' % (dest_path, self.return_port, self.query_string(query))
+        if self.receiver is not None:
+            series_uid = query.kwargs['SeriesInstanceUID']
+            success, img_cnts = self.__move_shared(query, series_uid, {series_uid: dest_path})
+            return success, img_cnts[series_uid]
+        cmd = 'movescu -v -od %s --port %s %s %s' % (dest_path, self.return_port, self.transfer_syntax_option, self.query_string(query))
         log.debug(cmd)
         output = ''
         try:
-            output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT)
+            output = self.__check_output(cmd)
         except subprocess.CalledProcessError as ex:
             log.debug('%s: %s', type(ex).__name__, ex)
             if output:
@@ -105,6 +134,82 @@ class SCU(object):
             img_cnt = 0
         return success, img_cnt
 
+    def move_study(self, study_uid, series_paths, spool_path):
+        """
+        Move a whole study with one movescu call, routing instances of the series in series_paths into their
+        directories and discarding instances of other series. Return success and the count of images per series.
+        """
+        query = StudyQuery(StudyInstanceUID=study_uid)
+        if self.receiver is not None:
+            success, img_cnts = self.__move_shared(query, study_uid, dict(series_paths, **{study_uid: None}))
+            img_cnts.pop(study_uid)
+            return success, img_cnts
+        success, _ = self.move(query, spool_path)
+        img_cnts = dict.fromkeys(series_paths, 0)
+        for filename in os.listdir(spool_path):
+            filepath = os.path.join(spool_path, filename)
+            try:
+                series_uid = dcm.DicomFile(filepath).raw.SeriesInstanceUID
+            except (dcm.DicomFileError, AttributeError, IOError):
+                series_uid = None
+            if series_uid in series_paths:
+                os.rename(filepath, os.path.join(series_paths[series_uid], filename))
+                img_cnts[series_uid] += 1
+            else:
+                os.remove(filepath)
+        return success, img_cnts
+
+    def __move_shared(self, query, wait_uid, routes):
+        """
+        Move via the shared receiver, which routes instances by the uids in routes (see StorageSCP.register), until
+        the route of wait_uid has received all completed sub-operations. Return success and the count per route.
+        """
+        cmd = 'movescu -v --move %s %s' % (self.receiver.aet, self.query_string(query))
+        log.debug(cmd)
+        for uid, dest_path in routes.iteritems():
+            self.receiver.register(uid, dest_path)
+        try:
+            output = self.__check_output(cmd)
+        except subprocess.CalledProcessError as ex:
+            log.debug('%s: %s', type(ex).__name__, ex)
+            output = ex.output or ''
+        try:
+            success = bool(re.search(r'I: Received Final Move Response \(Success\)', output))
+            completed = [int(match_obj.group('count')) for match_obj in COMPLETED_RE.finditer(output)]
+            if success and completed:
+                self.receiver.wait(wait_uid, completed[-1])
+            elif output:
+                log.debug(output)
+        finally:
+            img_cnts = {uid: self.receiver.unregister(uid) for uid in routes}
+        return success, img_cnts
+
+    def terminate(self):
+        """Terminate all running findscu and movescu processes, which then fail."""
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            if process.poll() is None:
+                log.warning('Terminating  DCMTK process %d', process.pid)
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def __check_output(self, cmd):
+        """Like subprocess.check_output(), but keeping track of the process group so it can be terminated."""
+        process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        with self.lock:
+            self.processes.add(process)
+        try:
+            output, _ = process.communicate()
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output=output)
+        return output
+
     def query_string(self, query):
         """Convert a query into a string to be appended to a findscu or movescu call."""
         return '-S -aet %s -aec %s %s %s %s' % (self.aet, self.aec, query, self.host, str(self.port))
@@ -0,0 +1,103 @@
+"""SciTran Reaper SQLite state backend"""
+
+import json
+import sqlite3
+import logging
+import threading
+
+from . import util
+
+log = logging.getLogger(__name__)
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    reaped INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    lastseen REAL NOT NULL,
+    state TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS items_reaped ON items (reaped);
+CREATE INDEX IF NOT EXISTS items_failures ON items (failures);
+CREATE INDEX IF NOT EXISTS items_lastseen ON items (lastseen);
+"""
+
+
+def is_sqlite_path(path):
+    # pylint: disable=missing-docstring
+    return path is not None and path.lower().endswith(SQLITE_EXTENSIONS)
+
+
+def _dumps(obj):
+    # pylint: disable=missing-docstring
+    return json.dumps(obj, separators=(',', ':'), default=util.datetime_encoder)
+
+
+def _loads(text):
+    # pylint: disable=missing-docstring
+    if '$isotimestamp' in text:
+        return json.loads(text, object_hook=util.datetime_decoder)
+    return json.loads(text)
+
+
+class StateDB(object):
+
+    """
+    SQLite (WAL mode) store for ReaperState.
+
+    Items are stored one row each, with indexed reaped, failures and lastseen columns. Saving a state that was
+    loaded from or saved to this store before only writes the items changed or removed since, in one transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.saved_state = None
+
+    def load(self, state):
+        """Load all items into an empty ReaperState and return it."""
+        with self.lock:
+            rows = self.conn.execute('SELECT id, reaped, failures, lastseen, state, extra FROM items').fetchall()
+        for _id, reaped, failures, lastseen, item_state, extra in rows:
+            state.add_persisted(_id, _loads(item_state), bool(reaped), failures, lastseen, _loads(extra) if extra else None)
+        state.changes()
+        self.saved_state = state
+        return state
+
+    def save(self, state):
+        """Persist changes of a previously loaded or saved state, or replace all items with a new state."""
+        changed, removed = state.changes()
+        if state is not self.saved_state:
+            changed, removed = state.keys(), None
+        rows = [self.__row(_id, state[_id]) for _id in changed]
+        with self.lock, self.conn:
+            if removed is None:
+                self.conn.execute('DELETE FROM items')
+            elif removed:
+                self.conn.executemany('DELETE FROM items WHERE id = ?', [(_id,) for _id in removed])
+            self.conn.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.saved_state = state
+        log.debug('Persisted    %d changed, %d removed items', len(rows), len(removed or ()))
+
+    def unreaped_cnt(self):
+        # pylint: disable=missing-docstring
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM items WHERE reaped = 0').fetchone()[0]
+
+    def close(self):
+        # pylint: disable=missing-docstring
+        with self.lock:
+            self.conn.close()
+
+    @staticmethod
+    def __row(_id, item):
+        # pylint: disable=missing-docstring
+        extra = _dumps(item.extra) if item.extra else None
+        return (_id, int(bool(item.reaped)), item.failures, item.lastseen, _dumps(item.state), extra)
@@ -0,0 +1,128 @@
+"""SciTran Reaper tiered temporary storage with background cleanup"""
+
+import os
+import Queue
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+import contextlib
+
+from . import util
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'reaper-'
+TRASH_PREFIX = 'trash-'
+FAST_LIMIT = 512 * 1024 * 1024
+
+
+def free_bytes(path):
+    # pylint: disable=missing-docstring
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def pid_alive(pid):
+    # pylint: disable=missing-docstring
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+class TempManager(object):
+
+    """
+    TempManager hands out per-item temporary directories from a fast tier (e.g. tmpfs) and a disk tier.
+
+    Items whose expected size is known and below fast_limit go to the fast tier if it has room; everything else goes
+    to disk. Directories are named after the owning process. On exit from directory(), a directory is renamed out of
+    the way and removed by a background thread, so reaping continues right away. Directories of processes that are no
+    longer running, e.g. after a crash, are removed at startup. Given min_free, has_space() lets callers throttle before
+    the disk fills up, counting space still held by directories awaiting removal as used.
+    """
+
+    def __init__(self, disk_dir=None, fast_dir=None, fast_limit=None, min_free=None):
+        self.disk_dir = disk_dir or tempfile.gettempdir()
+        self.fast_dir = fast_dir
+        self.fast_limit = FAST_LIMIT if fast_limit is None else fast_limit
+        self.min_free = min_free
+        self.prefix = '%s%d-' % (PREFIX, os.getpid())
+        self.trash = Queue.Queue()
+        for tier_dir in self.tiers:
+            self.recover_orphans(tier_dir)
+        self.cleaner = threading.Thread(target=self.__clean)
+        self.cleaner.daemon = True
+        self.cleaner.start()
+
+    @property
+    def tiers(self):
+        # pylint: disable=missing-docstring
+        return [tier_dir for tier_dir in (self.fast_dir, self.disk_dir) if tier_dir]
+
+    @staticmethod
+    def recover_orphans(tier_dir):
+        """Remove directories left behind by reaper processes that are no longer running."""
+        for name in os.listdir(tier_dir):
+            rest = name[len(TRASH_PREFIX):] if name.startswith(TRASH_PREFIX) else name
+            if not rest.startswith(PREFIX):
+                continue
+            try:
+                pid = int(rest[len(PREFIX):].split('-', 1)[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not pid_alive(pid):
+                log.warning('Removing     orphaned temporary directory %s', os.path.join(tier_dir, name))
+                shutil.rmtree(os.path.join(tier_dir, name), ignore_errors=True)
+
+    def has_space(self, size_hint=None):
+        """Return True if the disk tier keeps min_free bytes free after storing size_hint more bytes, or if unlimited."""
+        if self.min_free is None:
+            return True
+        return free_bytes(self.disk_dir) - (size_hint or 0) >= self.min_free
+
+    def usage(self):
+        # pylint: disable=missing-docstring
+        return ', '.join('%s %s free' % (tier_dir, util.hrsize(free_bytes(tier_dir))) for tier_dir in self.tiers)
+
+    def mkdtemp(self, size_hint=None):
+        """Return a new temporary directory on the tier fitting size_hint; the caller discards it when done."""
+        tier_dir = self.disk_dir
+        if self.fast_dir and size_hint is not None and size_hint <= self.fast_limit and free_bytes(self.fast_dir) > 2 * size_hint:
+            tier_dir = self.fast_dir
+        return tempfile.mkdtemp(prefix=self.prefix, dir=tier_dir)
+
+    @contextlib.contextmanager
+    def directory(self, size_hint=None):
+        """Yield a new temporary directory on the tier fitting size_hint, removed in the background afterwards."""
+        path = self.mkdtemp(size_hint)
+        try:
+            yield path
+        finally:
+            self.discard(path)
+
+    def discard(self, path):
+        """Rename path out of the way and schedule it for removal."""
+        trash_path = os.path.join(os.path.dirname(path), TRASH_PREFIX + os.path.basename(path))
+        try:
+            os.rename(path, trash_path)
+        except OSError:
+            trash_path = path
+        self.trash.put(trash_path)
+
+    def close(self):
+        """Wait for all pending removals and stop the cleanup thread."""
+        if self.cleaner.is_alive():
+            self.trash.put(None)
+            self.cleaner.join()
+
+    def __clean(self):
+        # pylint: disable=missing-docstring
+        while True:
+            path = self.trash.get()
+            if path is None:
+                break
+            shutil.rmtree(path, ignore_errors=True)
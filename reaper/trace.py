@@ -0,0 +1,162 @@
+"""SciTran Reaper per-item stage tracing"""
+
+import os
+import json
+import time
+import logging
+import cProfile
+import datetime
+import threading
+import contextlib
+
+log = logging.getLogger(__name__)
+
+_LOCAL = threading.local()
+
+
+class Trace(object):
+
+    """
+    Trace collects timed spans for the stages of reaping one item.
+
+    Spans record their duration and, where the stage sets them, the number of files and bytes it handled. With a
+    profile threshold, the outermost span open in a thread runs under cProfile, and its stats are written to
+    profile_dir if the stage took at least profile_threshold seconds. Nested spans are timed but not profiled
+    separately, since cProfile only supports one active profiler per thread.
+    """
+
+    def __init__(self, _id, profile_threshold=None, profile_dir=None):
+        self._id = _id
+        self.profile_threshold = profile_threshold
+        self.profile_dir = profile_dir
+        self.start = time.time()
+        self.spans = []
+        self.depth = 0
+
+    @property
+    def config(self):
+        """Arguments for creating a Trace for the same item in another process."""
+        return self._id, self.profile_threshold, self.profile_dir
+
+    @contextlib.contextmanager
+    def span(self, stage, files=None, nbytes=None):
+        """Time the enclosed stage; the yielded dict accepts 'files' and 'bytes' counts known only afterwards."""
+        entry = {'stage': stage, 'depth': self.depth, 'files': files, 'bytes': nbytes}
+        profiler = None
+        if self.profile_threshold is not None and self.depth == 0:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.depth += 1
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['start'] = start
+            entry['duration'] = time.time() - start
+            self.depth -= 1
+            if profiler is not None:
+                profiler.disable()
+                if entry['duration'] >= self.profile_threshold:
+                    entry['profile'] = self.__dump_profile(profiler, stage, start)
+            self.spans.append(entry)
+
+    def extend(self, spans):
+        """Add spans recorded by a Trace of the same item in another process."""
+        for entry in spans:
+            entry['depth'] += self.depth
+        self.spans.extend(spans)
+
+    def record(self, result):
+        """Return the JSON-serializable trace record of the item."""
+        spans = []
+        for entry in sorted(self.spans, key=lambda entry: entry['start']):
+            offset = round(entry['start'] - self.start, 3)
+            entry = {k: v for k, v in entry.iteritems() if v is not None and k != 'start'}
+            entry['offset'] = offset
+            if entry.get('bytes') and entry['duration']:
+                entry['throughput'] = int(entry['bytes'] / entry['duration'])
+            entry['duration'] = round(entry['duration'], 3)
+            spans.append(entry)
+        return {
+            'id': self._id,
+            'start': datetime.datetime.utcfromtimestamp(self.start).isoformat() + 'Z',
+            'duration': round(time.time() - self.start, 3),
+            'result': result,
+            'files': max([entry['files'] for entry in spans if entry.get('files')] or [0]),
+            'bytes': sum(entry['bytes'] for entry in spans if entry.get('bytes') and entry['stage'] == 'upload'),
+            'spans': spans,
+        }
+
+    def __dump_profile(self, profiler, stage, start):
+        # pylint: disable=missing-docstring
+        if not os.path.isdir(self.profile_dir):
+            try:
+                os.makedirs(self.profile_dir)
+            except OSError:
+                pass  # created concurrently
+        path = os.path.join(self.profile_dir, '%s_%s_%d.prof' % (self._id, stage, int(start * 1000)))
+        profiler.dump_stats(path)
+        return path
+
+
+def current():
+    """Return the Trace active in this thread, or None if the item is not traced."""
+    return getattr(_LOCAL, 'trace', None)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """Make trace the active Trace of this thread for the enclosed block."""
+    previous = current()
+    _LOCAL.trace = trace
+    try:
+        yield trace
+    finally:
+        _LOCAL.trace = previous
+
+
+@contextlib.contextmanager
+def span(stage, files=None, nbytes=None):
+    """Time the enclosed stage in the active Trace, if any; see Trace.span."""
+    trace = current()
+    if trace is None:
+        yield {}
+    else:
+        with trace.span(stage, files, nbytes) as entry:
+            yield entry
+
+
+def dir_size(path):
+    """Return the number of files in directory path and their total size in bytes."""
+    sizes = [os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path)]
+    return len(sizes), sum(sizes)
+
+
+class TraceWriter(object):
+
+    """
+    TraceWriter appends one JSON record per line to path for every traced item.
+
+    cProfile stats of slow stages go to the directory <path>.prof, one pstats file per stage, loadable with
+    `python -m pstats`.
+    """
+
+    def __init__(self, path, profile_threshold=None):
+        self.path = path
+        self.profile_threshold = profile_threshold
+        self.profile_dir = path + '.prof'
+        self.lock = threading.Lock()
+
+    def trace(self, _id):
+        # pylint: disable=missing-docstring
+        return Trace(_id, self.profile_threshold, self.profile_dir)
+
+    def write(self, trace, result):
+        """Append the record of trace to the trace file."""
+        line = json.dumps(trace.record(result), sort_keys=True) + '\n'
+        with self.lock:
+            try:
+                with open(self.path, 'a') as fd:
+                    fd.write(line)
+            except IOError as ex:
+                log.error('Tracing      failed to write %s: %s', self.path, ex)
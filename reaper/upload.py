@@ -1,45 +1,30 @@
 """SciTran Reaper upload utility functions"""
 
 import os
+import re
 import json
-import array
+import errno
+import shutil
 import logging
 import datetime
+import tempfile
+import urlparse
 
 import httplib
-import requests
-import requests_toolbelt
 
+from . import s3
 from . import util
+from . import trace
+from . import multipart
+
+requests = util.LazyModule('requests')  # pylint: disable=invalid-name
+requests_toolbelt = util.LazyModule('requests_toolbelt')  # pylint: disable=invalid-name
 
 log = logging.getLogger(__name__)
 logging.getLogger('requests').setLevel(logging.WARNING)
 
-
-# monkey patching httplib to increase performance due to hard-coded block size
-def __fast_http_send(self, data):
-    """Send `data' to the server."""
-    if self.sock is None:
-        if self.auto_open:
-            self.connect()
-        else:
-            raise httplib.NotConnected()
-
-    if self.debuglevel > 0:
-        print "send:", repr(data)
-    blocksize = 2**20  # was 8192 originally
-    if hasattr(data, 'read') and not isinstance(data, array.array):
-        if self.debuglevel > 0:
-            print "sendIng a read()able"
-        datablock = data.read(blocksize)
-        while datablock:
-            self.sock.sendall(datablock)
-            datablock = data.read(blocksize)
-    else:
-        self.sock.sendall(data)
-
-httplib.HTTPConnection.send = __fast_http_send
-httplib.HTTPSConnection.send = __fast_http_send
+METADATA_SUFFIX = '.metadata.json'
+INCOMING_DIR = '.incoming'
 
 
 def upload_many(metadata_map, upload_func):
@@ -56,7 +41,8 @@ def metadata_upload(filepath, metadata, upload_func):
     filename = os.path.basename(filepath)
     log.warning('Uploading    %s [%s]', filename, util.hrsize(os.path.getsize(filepath)))
     start = datetime.datetime.utcnow()
-    success = upload_func(filepath, metadata)
+    with trace.span('upload', files=1, nbytes=os.path.getsize(filepath)):
+        success = upload_func(filepath, metadata)
     duration = (datetime.datetime.utcnow() - start).total_seconds()
     if success:
         log.info('Uploaded     %s [%s/s]', filename, util.hrsize(os.path.getsize(filepath) / duration))
@@ -73,9 +59,9 @@ def upload_function(uri, secret_info=None, key=None, root=False, insecure=False,
     elif uri.startswith('dummy://'):
         return lambda method, route, **kwargs: True, lambda filepath, metadata: True
     elif uri.startswith('s3://'):
-        return __s3_upload
+        return lambda method, route, **kwargs: True, __s3_upload(uri, insecure)
     elif uri.startswith('file://'):
-        return __file_copy
+        return lambda method, route, **kwargs: True, __file_upload(os.path.abspath(uri[len('file://'):]))
     else:
         raise ValueError('bad upload URI "%s"' % uri)
 
@@ -83,6 +69,8 @@ def upload_function(uri, secret_info=None, key=None, root=False, insecure=False,
 def __http_upload(url, secret_info, key, root, insecure, upload_route):
     # pylint: disable=missing-docstring
     http_session = __request_session(secret_info, key, root, insecure)
+    proxied = bool(requests.utils.get_environ_proxies(url + upload_route))
+    verify = False if insecure else os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE') or requests.certs.where()
 
     def request(method, route, **kwargs):
         try:
@@ -99,22 +87,40 @@ def __http_upload(url, secret_info, key, root, insecure, upload_route):
     def upload(filepath, metadata):
         filename = os.path.basename(filepath)
         metadata_json = json.dumps(metadata, default=util.metadata_encoder)
-        with open(filepath, 'rb') as fd:
-            mpe = requests_toolbelt.multipart.encoder.MultipartEncoder(fields={'metadata': metadata_json, 'file': (filename, fd)})
-            try:
-                r = http_session.post(url + upload_route, data=mpe, headers={'Content-Type': mpe.content_type})
-            except requests.exceptions.ConnectionError as ex:
-                log.error('Error        %s: %s', filename, ex)
-                return False
-            if r.ok:
-                return True
-            else:
-                log.error('Failure      %s: %s %s', filename, r.status_code, r.reason)
-                return False
+        if proxied:  # multipart.post_file() doesn't do proxies
+            return __proxied_upload(http_session, url + upload_route, filepath, metadata_json)
+        try:
+            status, reason = multipart.post_file(url + upload_route, [('metadata', metadata_json)], 'file', filepath,
+                                                 http_session.headers, http_session.params, verify)
+        except (EnvironmentError, httplib.HTTPException, ValueError) as ex:  # ssl.CertificateError is a ValueError
+            log.error('Error        %s: %s', filename, ex)
+            return False
+        if 200 <= status < 300:  # redirects are not followed, so the file wasn't stored
+            return True
+        else:
+            log.error('Failure      %s: %s %s', filename, status, reason)
+            return False
 
     return request, upload
 
 
+def __proxied_upload(http_session, url, filepath, metadata_json):
+    # pylint: disable=missing-docstring
+    filename = os.path.basename(filepath)
+    with open(filepath, 'rb') as fd:
+        mpe = requests_toolbelt.multipart.encoder.MultipartEncoder(fields={'metadata': metadata_json, 'file': (filename, fd)})
+        try:
+            r = http_session.post(url, data=mpe, headers={'Content-Type': mpe.content_type})
+        except requests.exceptions.ConnectionError as ex:
+            log.error('Error        %s: %s', filename, ex)
+            return False
+        if r.ok:
+            return True
+        else:
+            log.error('Failure      %s: %s %s', filename, r.status_code, r.reason)
+            return False
+
+
 def __request_session(secret_info, key, root, insecure):
     # pylint: disable=missing-docstring
     if insecure:
@@ -131,11 +137,99 @@ def __request_session(secret_info, key, root, insecure):
     return rs
 
 
-def __s3_upload(filename, filepath, metadata, digest, uri):
-    # pylint: disable=missing-docstring, unused-argument
-    pass
+def __s3_upload(uri, insecure):
+    """
+    Return an upload function that stores archives in S3-compatible object storage.
+
+    The URI is s3://<bucket>[/<prefix>][?endpoint=<url>&region=<region>&part_size=<MiB>&concurrency=<parts>], with
+    credentials taken from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY. Archives are stored under the same
+    <group>/<project>/<session>/<acquisition>/ keys as with file://, followed by an <archive>.metadata.json sidecar
+    object once the archive is complete. Archives larger than part_size are uploaded in parallel parts.
+    """
+    parsed = urlparse.urlparse(uri)
+    options = dict(urlparse.parse_qsl(parsed.query))
+    access_key, secret_key = os.environ.get('AWS_ACCESS_KEY_ID'), os.environ.get('AWS_SECRET_ACCESS_KEY')
+    if not parsed.netloc or not access_key or not secret_key:
+        raise ValueError('s3:// uploads need a bucket, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY')
+    region = options.get('region') or os.environ.get('AWS_DEFAULT_REGION') or s3.REGION
+    part_size = int(options['part_size']) * 1024 * 1024 if options.get('part_size') else None
+    concurrency = int(options.get('concurrency') or s3.CONCURRENCY)
+    endpoint = options.get('endpoint') or 'https://s3.%s.amazonaws.com' % region
+    client = s3.S3Client(endpoint, parsed.netloc, access_key, secret_key, region, not insecure, concurrency)
+    prefix = [part for part in parsed.path.split('/') if part]
+
+    def upload(filepath, metadata):
+        # pylint: disable=missing-docstring
+        filename = os.path.basename(filepath)
+        try:
+            key = '/'.join(prefix + __tree_path(metadata) + [filename])
+            client.upload_file(key, filepath, part_size, concurrency)
+            client.request('PUT', key + METADATA_SUFFIX, headers={'Content-Type': 'application/json'},
+                           body=json.dumps(metadata, default=util.metadata_encoder))
+        except (s3.S3Error, EnvironmentError, TypeError, ValueError) as ex:
+            log.error('Failure      %s: %s', filename, ex)
+            return False
+        return True
+
+    return upload
+
+
+def __file_upload(root):
+    """
+    Return an upload function that delivers archives into the directory tree at root, for ingest from a shared
+    filesystem or as a sink without HTTP overhead.
 
+    Each archive lands in <group>/<project>/<session>/<acquisition>/ under root, next to a sidecar with its metadata
+    named <archive>.metadata.json. Both are staged in root/.incoming, synced and renamed into place, the sidecar last,
+    so an ingester that waits for the sidecar never sees partial files, even after a crash. Archives are hard-linked
+    on the same filesystem and copied with sendfile() otherwise; the caller still owns, and removes, the original file.
+    """
+    incoming_path = os.path.join(root, INCOMING_DIR)
+    if not os.path.isdir(incoming_path):
+        os.makedirs(incoming_path)
 
-def __file_copy(filename, filepath, metadata, digest, uri):
-    # pylint: disable=missing-docstring, unused-argument
-    pass
+    def upload(filepath, metadata):
+        # pylint: disable=missing-docstring
+        filename = os.path.basename(filepath)
+        staging_path = tempfile.mkdtemp(dir=incoming_path)
+        try:
+            target_path = os.path.join(root, *__tree_path(metadata))
+            if not os.path.isdir(target_path):
+                try:
+                    os.makedirs(target_path)
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:  # created by a concurrent upload
+                        raise
+            staged_path = os.path.join(staging_path, filename)
+            try:
+                os.link(filepath, staged_path)
+            except OSError:
+                util.copy_file(filepath, staged_path)  # synced
+            else:
+                util.fsync_path(staged_path)
+            with open(staged_path + METADATA_SUFFIX, 'w') as fd:
+                json.dump(metadata, fd, default=util.metadata_encoder)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(staged_path, os.path.join(target_path, filename))
+            os.rename(staged_path + METADATA_SUFFIX, os.path.join(target_path, filename + METADATA_SUFFIX))
+            util.fsync_path(target_path)
+        except (EnvironmentError, TypeError, ValueError) as ex:
+            log.error('Failure      %s: %s', filename, ex)
+            return False
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+        return True
+
+    return upload
+
+
+def __tree_path(metadata):
+    """Return the directory names for the group, project, session and acquisition of an upload, as far as known."""
+    path = []
+    for level, keys in (('group', ('_id',)), ('project', ('label',)), ('session', ('uid', 'label')), ('acquisition', ('uid', 'label'))):
+        value = next((metadata.get(level, {}).get(key) for key in keys if metadata.get(level, {}).get(key)), None)
+        if value:
+            value = value.decode('utf-8', 'replace') if isinstance(value, str) else unicode(value)
+            path.append(re.sub(r'[^\w.@-]', '_', value).encode('utf-8'))
+    return path
@@ -1,15 +1,46 @@
 """SciTran Reaper utility functions"""
 
 import os
+import sys
 import json
+import errno
+import shutil
 import string
 import logging
 import zipfile
 import datetime
+import importlib
 
-import pytz
-import tzlocal
-import dateutil.parser
+
+class LazyModule(object):
+
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    Keeps heavy dependencies out of the startup path of entry points that don't need them, e.g. for --help.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+
+pytz = LazyModule('pytz')  # pylint: disable=invalid-name
+tzlocal = LazyModule('tzlocal')  # pylint: disable=invalid-name
+dateutil_parser = LazyModule('dateutil.parser')  # pylint: disable=invalid-name
+ctypes = LazyModule('ctypes')  # pylint: disable=invalid-name
+ctypes_util = LazyModule('ctypes.util')  # pylint: disable=invalid-name
+
+SENDFILE_CHUNK = 64 * 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+_SENDFILE = []  # libc sendfile() once looked up, None if unavailable
 
 METADATA = [
     # required
@@ -86,13 +117,15 @@ def datetime_encoder(obj):
     # pylint: disable=missing-docstring
     if isinstance(obj, datetime.datetime):
         return {"$isotimestamp": obj.isoformat()}
+    elif hasattr(obj, 'to_dict'):
+        return obj.to_dict()
     raise TypeError(repr(obj) + " is not JSON serializable")
 
 
 def datetime_decoder(dct):
     # pylint: disable=missing-docstring
     if "$isotimestamp" in dct:
-        return dateutil.parser.parse(dct['$isotimestamp'])
+        return dateutil_parser.parse(dct['$isotimestamp'])
     return dct
 
 
@@ -120,8 +153,8 @@ def write_state_file(path, state):
     os.rename(temp_path, path)
 
 
-def create_archive(content, arcname, metadata=None, outdir=None):
-    # pylint: disable=missing-docstring
+def create_archive(content, arcname, metadata=None, outdir=None, stored=()):
+    """Zip a directory or list of files; files whose paths are in stored, e.g. already compressed ones, are not deflated."""
     if hasattr(content, '__iter__'):
         outdir = outdir or os.path.curdir
         files = [(os.path.basename(fp), fp) for fp in content]
@@ -134,10 +167,70 @@ def create_archive(content, arcname, metadata=None, outdir=None):
         if metadata is not None:
             zf.comment = json.dumps(metadata, default=metadata_encoder)
         for fn, fp in files:
-            zf.write(fp, os.path.join(arcname, fn))
+            zf.write(fp, os.path.join(arcname, fn), zipfile.ZIP_STORED if fp in stored else zipfile.ZIP_DEFLATED)
     return outpath
 
 
+def __libc_sendfile():
+    # pylint: disable=missing-docstring
+    if not _SENDFILE:
+        func = None
+        if sys.platform.startswith('linux'):
+            try:
+                func = ctypes.CDLL(ctypes_util.find_library('c') or 'libc.so.6', use_errno=True).sendfile
+                func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+                func.restype = ctypes.c_ssize_t
+            except (OSError, AttributeError):
+                func = None
+        _SENDFILE.append(func)
+    return _SENDFILE[0]
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """
+    Like os.sendfile() of Python 3: copy up to count bytes from offset in in_fd to out_fd within the kernel and return
+    the number of bytes sent. Raise OSError with errno ENOSYS where sendfile(2) is not available.
+    """
+    func = __libc_sendfile()
+    if func is None:
+        raise OSError(errno.ENOSYS, 'sendfile not available')
+    c_offset = ctypes.c_int64(offset)
+    sent = func(out_fd, in_fd, ctypes.byref(c_offset), count)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return sent
+
+
+def copy_file(src_path, dst_path):
+    """Copy a file with sendfile(), so the data doesn't pass through userspace, and sync it to disk."""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size, offset = os.fstat(src.fileno()).st_size, 0
+        try:
+            while offset < size:
+                sent = sendfile(dst.fileno(), src.fileno(), offset, min(size - offset, SENDFILE_CHUNK))
+                if not sent:
+                    break
+                offset += sent
+        except OSError as ex:
+            if ex.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+        if offset < size:  # no sendfile() for these files, copy the rest the usual way
+            src.seek(offset)
+            dst.seek(offset)
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+        os.fsync(dst.fileno())
+
+
+def fsync_path(path):
+    """Sync a file or directory to disk by path, e.g. a directory after renaming files into it."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def set_archive_metadata(path, metadata):
     # pylint: disable=missing-docstring
     with zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
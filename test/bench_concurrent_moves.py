@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Compare C-MOVEs of several series one at a time and all at once through the shared storage SCP.
+
+Writes synthetic series into a dcmqrscp archive, then moves them through a StorageSCP on one return port, first one
+after the other, then concurrently, with storescp forking per association (as the reaper runs it) and, for
+comparison, without forking. Requires DCMTK (dcmqridx, dcmqrscp, movescu, storescp) on the PATH.
+
+    python test/bench_concurrent_moves.py [series] [images] [rows]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import dicom
+import dicom.dataset
+
+from reaper import scp
+from reaper import scu
+
+PACS_PORT = 5106
+RETURN_PORT = 3335
+PACS_AET = 'BENCHPACS'
+AET = 'BENCHREAPER'
+
+CONFIG = """NetworkTCPPort  = %(pacs_port)d
+MaxPDUSize      = 16384
+MaxAssociations = 64
+
+HostTable BEGIN
+reaper          = (%(aet)s, localhost, %(return_port)d)
+HostTable END
+
+AETable BEGIN
+%(pacs_aet)s       %(db_dir)s RW (1000, 4096mb) ANY
+AETable END
+"""
+
+
+def write_instance(path, series_no, index, rows):
+    # pylint: disable=missing-docstring
+    meta = dicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.4.5.%d.%d' % (series_no, index)
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    meta.ImplementationClassUID = '1.2.3.4'
+    ds = dicom.dataset.FileDataset(path, {}, file_meta=meta, preamble='\0' * 128)
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID, ds.SOPInstanceUID = meta.MediaStorageSOPClassUID, meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = '1.2.3.4', '1.2.3.4.5.%d' % series_no
+    ds.PatientID, ds.PatientName = 'bench@group/project', 'Bench^Mark'
+    ds.StudyDate, ds.StudyTime, ds.StudyID = '20170101', '120000', '1'
+    ds.SeriesNumber, ds.InstanceNumber, ds.Modality = series_no, index + 1, 'MR'
+    ds.Rows = ds.Columns = rows
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation, ds.SamplesPerPixel = 16, 12, 11, 0, 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.add_new(0x7fe00010, 'OW', os.urandom(2 * rows * rows))
+    ds.save_as(path)
+
+
+def move_all(series_uids, workdir, concurrent):
+    """Move all series through one StorageSCP and return the seconds taken and the number of images received."""
+    receiver = scp.StorageSCP(RETURN_PORT, AET, os.path.join(workdir, 'spool'))
+    receiver.start()
+    time.sleep(1)
+    move_scu = scu.SCU('localhost', PACS_PORT, RETURN_PORT, AET, PACS_AET, receiver)
+    results = {}
+
+    def move(series_uid):
+        # pylint: disable=missing-docstring
+        dest_path = tempfile.mkdtemp(dir=workdir)
+        results[series_uid] = move_scu.move(scu.SeriesQuery(SeriesInstanceUID=series_uid), dest_path)[1]
+
+    start = time.time()
+    try:
+        if concurrent:
+            threads = [threading.Thread(target=move, args=(series_uid,)) for series_uid in series_uids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for series_uid in series_uids:
+                move(series_uid)
+        return time.time() - start, sum(results.itervalues())
+    finally:
+        receiver.stop()
+
+
+def main():
+    # pylint: disable=missing-docstring
+    series_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    image_cnt = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rows = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+    workdir = tempfile.mkdtemp()
+    pacs = None
+    try:
+        db_dir, data_dir = os.path.join(workdir, 'db'), os.path.join(workdir, 'data')
+        os.mkdir(db_dir)
+        os.mkdir(data_dir)
+        for series_no in xrange(1, series_cnt + 1):
+            for index in xrange(image_cnt):
+                write_instance(os.path.join(data_dir, '%03d_%04d.dcm' % (series_no, index)), series_no, index, rows)
+        subprocess.check_call(['dcmqridx', db_dir] + [os.path.join(data_dir, fn) for fn in sorted(os.listdir(data_dir))])
+        config_path = os.path.join(workdir, 'dcmqrscp.cfg')
+        with open(config_path, 'w') as fd:
+            fd.write(CONFIG % {'pacs_port': PACS_PORT, 'return_port': RETURN_PORT, 'aet': AET, 'pacs_aet': PACS_AET, 'db_dir': db_dir})
+        pacs = subprocess.Popen(['dcmqrscp', '-c', config_path])
+        time.sleep(1)
+
+        series_uids = ['1.2.3.4.5.%d' % series_no for series_no in xrange(1, series_cnt + 1)]
+        print '%d series of %d images of %dx%d' % (series_cnt, image_cnt, rows, rows)
+        for fork_option in (scp.FORK_OPTION, ''):
+            scp.FORK_OPTION = fork_option
+            for concurrent in (False, True):
+                moves_dir = os.path.join(workdir, 'moves')
+                os.mkdir(moves_dir)
+                seconds, received = move_all(series_uids, moves_dir, concurrent)
+                print '%-12s %-12s %8.2fs %6d images' % (
+                    'fork' if fork_option else 'no fork', 'concurrent' if concurrent else 'one by one', seconds, received)
+                shutil.rmtree(moves_dir)
+    finally:
+        if pacs is not None:
+            pacs.terminate()
+            pacs.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
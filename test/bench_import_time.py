@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Check the startup time of the CLI entry points against a budget.
+
+Runs each entry point with --help in a fresh interpreter, takes the best of a few runs, and fails if any exceeds the
+budget. Also fails if importing the reaper modules pulls in a dependency that is meant to be imported lazily.
+
+    python test/bench_import_time.py [budget in seconds]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+BUDGET = 0.25
+RUNS = 5
+ENTRY_POINTS = ['dicom_reaper', 'orthanc_reaper', 'pfile_reaper', 'dicom_sniper', 'dicom_folder_sniper', 'folder_sniper']
+MODULES = ['reaper.dicom_reaper', 'reaper.orthanc_reaper', 'reaper.pfile_reaper', 'reaper.upload', 'reaper.dcm', 'reaper.util']
+LAZY_MODULES = ['dicom', 'requests', 'requests_toolbelt', 'pytz', 'tzlocal', 'dateutil']
+
+CHECK_LAZY = """
+import sys
+for module in sys.argv[1].split(','):
+    __import__(module)
+print ','.join(module for module in sys.argv[2].split(',') if module in sys.modules)
+"""
+
+
+def startup_time(args, env):
+    # pylint: disable=missing-docstring
+    best = None
+    for _ in range(RUNS):
+        start = time.time()
+        subprocess.check_call(args, env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    # pylint: disable=missing-docstring
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONIOENCODING='utf-8')
+    ok = True
+
+    baseline = startup_time([sys.executable, '-c', 'pass'], env)
+    print '%-24s %6.3fs' % ('(interpreter)', baseline)
+    for entry_point in ENTRY_POINTS:
+        path = os.path.join(ROOT, 'bin', entry_point)
+        if not os.path.exists(path):
+            continue
+        duration = startup_time([sys.executable, path, '--help'], env)
+        over = duration > budget
+        ok = ok and not over
+        print '%-24s %6.3fs%s' % (entry_point, duration, '  over budget of %.3fs' % budget if over else '')
+
+    imported = subprocess.check_output([sys.executable, '-c', CHECK_LAZY, ','.join(MODULES), ','.join(LAZY_MODULES)], env=env).strip()
+    if imported:
+        ok = False
+        print 'imported eagerly: %s' % imported
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compare the JSON and SQLite reaper state backends.
+
+Measures a full load, a full save, and the incremental save after marking one item reaped, which is what the reaper
+does after every reaped item.
+
+    python test/bench_state_backends.py 10000 100000 1000000
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from reaper import util
+from reaper import reaper
+from reaper import statedb
+
+
+def make_state(item_cnt):
+    # pylint: disable=missing-docstring
+    state = reaper.ReaperState()
+    for i in xrange(item_cnt):
+        item_state = {'images': i % 500, 'opt': None, 'study': '1.2.840.113619.2.%d' % (i // 10)}
+        state['1.2.840.113619.2.%d.%d' % (i // 10, i)] = reaper.ReaperItem(item_state, reaped=bool(i % 3))
+    return state
+
+
+def timed(func, *args):
+    # pylint: disable=missing-docstring
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def bench_json(path, state):
+    # pylint: disable=missing-docstring
+    save_time, _ = timed(util.write_state_file, path, state)
+    load_time, loaded = timed(lambda: reaper.ReaperState(util.read_state_file(path)))
+    loaded[next(iter(loaded.unreaped))]['reaped'] = True
+    update_time, _ = timed(util.write_state_file, path, loaded)
+    return save_time, load_time, update_time, os.path.getsize(path)
+
+
+def bench_sqlite(path, state):
+    # pylint: disable=missing-docstring
+    state_db = statedb.StateDB(path)
+    save_time, _ = timed(state_db.save, state)
+    state_db.close()
+    state_db = statedb.StateDB(path)
+    load_time, loaded = timed(state_db.load, reaper.ReaperState())
+    loaded[next(iter(loaded.unreaped))]['reaped'] = True
+    update_time, _ = timed(state_db.save, loaded)
+    state_db.close()
+    return save_time, load_time, update_time, os.path.getsize(path)
+
+
+def main():
+    # pylint: disable=missing-docstring
+    item_cnts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    tempdir = tempfile.mkdtemp()
+    try:
+        print '%10s %8s %10s %10s %12s %10s' % ('items', 'backend', 'save', 'load', 'reap+save', 'size')
+        for item_cnt in item_cnts:
+            state = make_state(item_cnt)
+            for name, bench, filename in (('json', bench_json, 'state.json'), ('sqlite', bench_sqlite, 'state.sqlite')):
+                save_time, load_time, update_time, size = bench(os.path.join(tempdir, '%d-%s' % (item_cnt, filename)), state)
+                print '%10d %8s %9.2fs %9.2fs %11.3fs %10s' % (item_cnt, name, save_time, load_time, update_time, util.hrsize(size))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
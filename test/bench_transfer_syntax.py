@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Compare received bytes and packaging time of a series in uncompressed and compressed transfer syntaxes.
+
+Writes a synthetic MR-like series as explicit VR little endian and as deflated explicit VR little endian, the
+compressed syntax that can be produced without an image codec. For each, reports the bytes on the wire (the size of
+the received files), the time to archive them deflating every file as before, the time when already-compressed files
+are stored as they are, and the time of the whole of dcm.pkg_series.
+
+    python test/bench_transfer_syntax.py [images] [rows]
+"""
+
+import os
+import sys
+import zlib
+import time
+import array
+import random
+import shutil
+import struct
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import dicom
+import dicom.dataset
+
+from reaper import dcm
+from reaper import util
+
+UNCOMPRESSED = dcm.EXPLICIT_VR_LITTLE_ENDIAN
+DEFLATED = dcm.DEFLATED_TRANSFER_SYNTAX
+
+
+def pixel_data(rows, seed):
+    """Return smooth 12-bit pixel values with noise, roughly like an MR magnitude image."""
+    rnd = random.Random(seed)
+    center = rows / 2.0
+    pixels = array.array('H', [0] * rows * rows)
+    for y in xrange(rows):
+        for x in xrange(rows):
+            r2 = ((x - center) ** 2 + (y - center) ** 2) / (center * center)
+            base = 2000 * (1 - r2) if r2 < 1 else 0
+            pixels[y * rows + x] = max(0, min(4095, int(base + rnd.gauss(0, 40 if base else 8))))
+    return pixels.tostring()
+
+
+def write_instance(path, transfer_syntax, index, rows, pixels):
+    # pylint: disable=missing-docstring
+    meta = dicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.4.5.%d' % index
+    meta.TransferSyntaxUID = transfer_syntax
+    meta.ImplementationClassUID = '1.2.3.4'
+    ds = dicom.dataset.FileDataset(path, {}, file_meta=meta, preamble='\0' * 128)
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID, ds.SOPInstanceUID = meta.MediaStorageSOPClassUID, meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = '1.2.3.4', '1.2.3.4.5'
+    ds.PatientID, ds.PatientName, ds.PatientBirthDate = 'bench@group/project', 'Bench^Mark', '19700101'
+    ds.StudyDate = ds.AcquisitionDate = '20170101'
+    ds.StudyTime, ds.AcquisitionTime = '120000', '120500'
+    ds.StudyID, ds.SeriesNumber, ds.InstanceNumber, ds.AcquisitionNumber = '1', 1, index + 1, 1
+    ds.Manufacturer, ds.Modality, ds.SeriesDescription = 'GE MEDICAL SYSTEMS', 'MR', 'bench'
+    ds.Rows = ds.Columns = rows
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation, ds.SamplesPerPixel = 16, 12, 11, 0, 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.add_new(0x7fe00010, 'OW', pixels)
+    ds.save_as(path)
+    if transfer_syntax == DEFLATED:
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        meta_end = 132 + 12 + struct.unpack('<I', data[140:144])[0]  # after the (0002,0000) group length element
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        with open(path, 'wb') as fd:
+            fd.write(data[:meta_end] + compressor.compress(data[meta_end:]) + compressor.flush())
+
+
+def timed(func, *args, **kwargs):
+    # pylint: disable=missing-docstring
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def bench(workdir, transfer_syntax, image_cnt, images):
+    # pylint: disable=missing-docstring
+    series_dir = os.path.join(workdir, 'series')
+    os.mkdir(series_dir)
+    for i in xrange(image_cnt):
+        write_instance(os.path.join(series_dir, '%04d' % i), transfer_syntax, i, images[0], images[1][i % len(images[1])])
+    paths = [os.path.join(series_dir, fn) for fn in os.listdir(series_dir)]
+    wire_bytes = sum(os.path.getsize(path) for path in paths)
+    stored = set(path for path in paths if dcm.is_compressed_syntax(dcm.DicomFile(path).transfer_syntax))
+
+    deflate_time, arc_path = timed(util.create_archive, series_dir, 'deflate', outdir=workdir)
+    deflate_size = os.path.getsize(arc_path)
+    store_time, arc_path = timed(util.create_archive, series_dir, 'store', outdir=workdir, stored=stored)
+    store_size = os.path.getsize(arc_path)
+    pkg_time, metadata_map = timed(dcm.pkg_series, '1.2.3.4.5', series_dir, 'PatientID')
+    pkg_size = sum(os.path.getsize(path) for path in metadata_map)
+    shutil.rmtree(workdir)
+    os.mkdir(workdir)
+    return wire_bytes, deflate_time, deflate_size, store_time, store_size, pkg_time, pkg_size
+
+
+def main():
+    # pylint: disable=missing-docstring
+    image_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    images = (rows, [pixel_data(rows, seed) for seed in range(4)])
+    workdir = tempfile.mkdtemp()
+    try:
+        print '%d images of %dx%d' % (image_cnt, rows, rows)
+        print '%-14s %10s %20s %20s %20s' % ('syntax', 'wire', 'archive (deflate)', 'archive (store)', 'pkg_series')
+        for name, transfer_syntax in (('uncompressed', UNCOMPRESSED), ('deflated', DEFLATED)):
+            wire, deflate_time, deflate_size, store_time, store_size, pkg_time, pkg_size = bench(workdir, transfer_syntax, image_cnt, images)
+            print '%-14s %10s %10s %8.2fs %10s %8.2fs %10s %8.2fs' % (
+                name, util.hrsize(wire), util.hrsize(deflate_size), deflate_time, util.hrsize(store_size), store_time,
+                util.hrsize(pkg_size), pkg_time)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Measure the client CPU time per uploaded GB of the HTTP(S) upload transport.
+
+Starts a sink server in a separate process that discards upload bodies, checks once that a small upload arrives intact
+(parsing the multipart body and comparing the MD5 of the file with the one sent in the metadata), then uploads a file
+of the given size several times and reports user and system CPU seconds per GB of the uploading process.
+
+    python test/bench_upload_transport.py [--size MiB] [--runs N] [--tls]
+"""
+
+import os
+import cgi
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from reaper import upload  # pylint: disable=wrong-import-position
+
+PORT = 9020
+CHECK_LIMIT = 16 * 1024 * 1024
+
+
+class SinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # pylint: disable=missing-docstring,invalid-name
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        status = 200
+        if length < CHECK_LIMIT:
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={'REQUEST_METHOD': 'POST'})
+            if hashlib.md5(form['file'].value).hexdigest() != json.loads(form['metadata'].value).get('md5'):
+                status = 400
+        else:
+            while length:
+                length -= len(self.rfile.read(min(length, 1024 * 1024)))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+
+
+def serve(cert):
+    # pylint: disable=missing-docstring
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', PORT), SinkHandler)
+    if cert:
+        import ssl
+        server.socket = ssl.wrap_socket(server.socket, certfile=cert, server_side=True)
+    server.serve_forever()
+
+
+def cpu_times():
+    # pylint: disable=missing-docstring
+    times = os.times()
+    return times[0], times[1], times[4]
+
+
+def main():
+    # pylint: disable=missing-docstring
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--size', type=int, default=1024, help='upload size in MiB [1024]')
+    arg_parser.add_argument('--runs', type=int, default=3, help='number of uploads, the best one counts [3]')
+    arg_parser.add_argument('--tls', action='store_true', help='upload over HTTPS with a self-signed certificate')
+    arg_parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.serve is not None:
+        return serve(args.serve)
+
+    workdir = tempfile.mkdtemp()
+    server = None
+    try:
+        cert = ''
+        if args.tls:
+            cert = os.path.join(workdir, 'cert.pem')
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=127.0.0.1', '-days', '1',
+                                   '-keyout', cert, '-out', cert], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', cert])
+        time.sleep(1)
+        _, upload_function = upload.upload_function('%s://127.0.0.1:%d' % ('https' if args.tls else 'http', PORT), insecure=True)
+
+        small_path = os.path.join(workdir, 'small.zip')
+        with open(small_path, 'wb') as fd:
+            fd.write(os.urandom(3 * 1024 * 1024 + 17))
+        with open(small_path, 'rb') as fd:
+            intact = upload_function(small_path, {'md5': hashlib.md5(fd.read()).hexdigest()})
+        print 'small upload intact: %s' % intact
+
+        path = os.path.join(workdir, 'bench.zip')
+        with open(path, 'wb') as fd:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(args.size):
+                fd.write(block)
+        best = None
+        for _ in xrange(args.runs):
+            start = cpu_times()
+            success = upload_function(path, {'md5': None})
+            end = cpu_times()
+            result = [(end[i] - start[i]) * 1024 / args.size for i in range(3)]
+            if success and (best is None or result[0] + result[1] < best[0] + best[1]):
+                best = result
+        if best is None:
+            print 'uploads failed'
+        else:
+            print '%s per GB: user %.2fs, sys %.2fs, wall %.2fs' % ('https' if args.tls else 'http', best[0], best[1], best[2])
+    finally:
+        if server is not None:
+            server.terminate()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
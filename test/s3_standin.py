@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Minimal S3-compatible stand-in for trying the s3:// upload backend without object storage.
+
+Stores objects as files below a directory and implements what the reaper uses: PUT of objects, multipart uploads
+(initiate, upload part, complete, abort) and GET. Each request's Signature Version 4 is checked against the request as
+received, so signing problems in transit show up as 403 SignatureDoesNotMatch. With --fail-every N, every N-th part
+upload fails with 500, to exercise part retries.
+
+    python test/s3_standin.py [--port 9000] [--fail-every N] DIR
+    AWS_ACCESS_KEY_ID=standin AWS_SECRET_ACCESS_KEY=standin bin/... 's3://bucket/prefix?endpoint=http://localhost:9000'
+"""
+
+import os
+import re
+import sys
+import uuid
+import shutil
+import hashlib
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from reaper import s3  # pylint: disable=wrong-import-position
+
+AUTH_RE = re.compile(r'AWS4-HMAC-SHA256 Credential=(?P<key>[^/]+)/\d{8}/(?P<region>[^/]+)/s3/aws4_request, '
+                     r'SignedHeaders=(?P<headers>[^,]+), Signature=(?P<signature>\w+)')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # pylint: disable=missing-docstring,invalid-name
+
+    protocol_version = 'HTTP/1.1'
+    part_cnt = 0
+    lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, code):
+        self.reply(status, '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>%s</Code></Error>' % code)
+
+    def handle_request(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.authorized(path, params, body):
+            return self.error(403, 'SignatureDoesNotMatch')
+        obj_path = os.path.join(self.server.root, urlparse.unquote(path).lstrip('/'))
+        if 'uploads' in params:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.server.root, '.uploads', upload_id))
+            return self.reply(200, '<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>' % upload_id)
+        if 'uploadId' in params:
+            return self.multipart(obj_path, params, body)
+        if self.command == 'PUT':
+            write(obj_path, [body])
+            return self.reply(200, headers={'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+        if self.command in ('GET', 'HEAD') and os.path.isfile(obj_path):
+            with open(obj_path, 'rb') as fd:
+                return self.reply(200, fd.read() if self.command == 'GET' else '')
+        return self.error(404, 'NoSuchKey')
+
+    def multipart(self, obj_path, params, body):
+        upload_path = os.path.join(self.server.root, '.uploads', params['uploadId'])
+        if not os.path.isdir(upload_path):
+            return self.error(404, 'NoSuchUpload')
+        if self.command == 'PUT':
+            with self.lock:
+                Handler.part_cnt += 1
+                fail = self.server.fail_every and Handler.part_cnt % self.server.fail_every == 0
+            if fail:
+                return self.error(500, 'InternalError')
+            write(os.path.join(upload_path, '%05d' % int(params['partNumber'])), [body])
+            return self.reply(200, headers={'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+        if self.command == 'DELETE':
+            shutil.rmtree(upload_path)
+            return self.reply(204)
+        part_nos = [int(part_no) for part_no in re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+        if part_nos != sorted(part_nos) or any(not os.path.exists(os.path.join(upload_path, '%05d' % no)) for no in part_nos):
+            return self.error(400, 'InvalidPart')
+        write(obj_path, [os.path.join(upload_path, '%05d' % part_no) for part_no in part_nos], from_files=True)
+        shutil.rmtree(upload_path)
+        return self.reply(200, '<CompleteMultipartUploadResult><ETag>"multipart"</ETag></CompleteMultipartUploadResult>')
+
+    def authorized(self, path, params, body):
+        match = AUTH_RE.match(self.headers.get('Authorization', ''))
+        if not match or match.group('key') != self.server.access_key:
+            return False
+        if self.headers.get('x-amz-content-sha256') != hashlib.sha256(body).hexdigest():
+            return False
+        headers = {name: self.headers.get(name) for name in match.group('headers').split(';')}
+        client = s3.S3Client('http://' + self.headers.get('host'), '', self.server.access_key, self.server.secret_key, match.group('region'))
+        return client.authorization(self.command, path, params, headers) == self.headers['Authorization']
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_request
+
+
+def write(path, chunks, from_files=False):
+    # pylint: disable=missing-docstring
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'wb') as fd:
+        for chunk in chunks:
+            if from_files:
+                with open(chunk, 'rb') as part_fd:
+                    shutil.copyfileobj(part_fd, fd, 1024 * 1024)
+            else:
+                fd.write(chunk)
+    os.rename(path + '.tmp', path)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # pylint: disable=missing-docstring
+    daemon_threads = True
+
+
+def main():
+    # pylint: disable=missing-docstring
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('root', help='directory to store objects in, as <bucket>/<key>')
+    arg_parser.add_argument('--port', type=int, default=9000, help='port to listen on [9000]')
+    arg_parser.add_argument('--fail-every', type=int, help='fail every N-th part upload with 500')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='log requests')
+    args = arg_parser.parse_args()
+    server = Server(('127.0.0.1', args.port), Handler)
+    server.root, server.fail_every, server.verbose = os.path.abspath(args.root), args.fail_every, args.verbose
+    server.access_key = os.environ.get('AWS_ACCESS_KEY_ID', 'standin')
+    server.secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY', 'standin')
+    print 'S3 stand-in for %s on http://127.0.0.1:%d' % (server.root, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,10 @@ PORT=${PORT:-"8027"}
 HOST=${HOST:-"http://localhost:$PORT"}
 
 
+# Run unit tests
+python -m pytest -q test/unit
+
+
 # Set up exit and error trap to shutdown dependencies
 shutdown() {
     echo 'Exit signal trapped'
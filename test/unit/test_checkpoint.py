@@ -0,0 +1,34 @@
+"""Tests of resumable upload checkpoints"""
+
+# pylint: disable=missing-docstring,invalid-name
+
+from reaper import checkpoint
+
+
+def test_resume_skips_finished_tasks_and_retries_failed_ones(tmpdir):
+    path = str(tmpdir.join('checkpoint.jsonl'))
+    with checkpoint.Checkpoint(path) as cp:
+        cp.record('a', True)
+        cp.record('b', False)
+        cp.record('c', False)
+        cp.record('c', True)  # the last result wins
+    with open(path, 'a') as fd:
+        fd.write('{"key": "d", "succ')  # interrupted write
+    runs = []
+    tasks = [(key, lambda key=key: runs.append(key) or True) for key in 'abcd']
+    with checkpoint.Checkpoint(path, resume=True) as cp:
+        assert (cp.done_cnt, cp.is_done('a'), cp.is_done('b'), cp.is_done('c')) == (2, True, False, True)
+        checkpoint.run_tasks(tasks, cp)
+    assert sorted(runs) == ['b', 'd']
+    with checkpoint.Checkpoint(path, resume=True) as cp:
+        assert all(cp.is_done(key) for key in 'abcd')
+
+
+def test_without_resume_the_checkpoint_starts_over(tmpdir):
+    path = str(tmpdir.join('checkpoint.jsonl'))
+    with checkpoint.Checkpoint(path) as cp:
+        cp.record('a', True)
+    with checkpoint.Checkpoint(path) as cp:
+        assert not cp.is_done('a')
+    with checkpoint.Checkpoint(path, resume=True) as cp:
+        assert cp.done_cnt == 0
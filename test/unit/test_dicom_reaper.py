@@ -0,0 +1,35 @@
+"""Tests of the C-FIND opt-in wildcard translation"""
+
+# pylint: disable=missing-docstring,invalid-name
+
+import re
+import fnmatch
+
+import pytest
+
+from reaper.dicom_reaper import find_wildcard
+
+
+@pytest.mark.parametrize('pattern, wildcard', [
+    ('research', '*research*'),
+    ('^research', 'research*'),
+    ('research$', '*research'),
+    ('^research$', 'research'),
+    ('res.*arch', '*res*arch*'),
+    ('res.arch', '*res?arch*'),
+    (r'fMRI\-study 2', '*fMRI-study 2*'),
+    ('.*', '*'),
+])
+def test_translatable_patterns(pattern, wildcard):
+    assert find_wildcard(pattern) == wildcard
+
+
+@pytest.mark.parametrize('pattern', ['res|arch', '[Rr]esearch', 'research+', 'research?', r'\d+', '(research)'])
+def test_regular_expression_syntax_is_not_translated(pattern):
+    assert find_wildcard(pattern) is None
+
+
+@pytest.mark.parametrize('value', ['research', 'my research study', 'Research', 'researcher', 'res', ''])
+def test_wildcard_matches_like_re_search(value):
+    for pattern in ('research', '^research', 'research$', 'res.*ch'):
+        assert fnmatch.fnmatchcase(value, find_wildcard(pattern)) == bool(re.search(pattern, value))
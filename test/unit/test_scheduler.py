@@ -0,0 +1,49 @@
+"""Tests of the poll and retry scheduling policies"""
+
+# pylint: disable=missing-docstring,invalid-name
+
+import random
+
+from reaper import scheduler
+
+
+def test_retry_backoff_doubles_up_to_retry_max(monkeypatch):
+    monkeypatch.setattr(random, 'uniform', lambda low, high: high)
+    policy = scheduler.RetryPolicy(retry_min=60, retry_max=600)
+    assert [policy.next_attempt(failures, 1000) - 1000 for failures in range(1, 7)] == [60, 120, 240, 480, 600, 600]
+
+
+def test_retry_jitter_stays_between_half_and_full_delay():
+    policy = scheduler.RetryPolicy(retry_min=100, retry_max=100)
+    delays = [policy.next_attempt(1, 0) for _ in range(200)]
+    assert all(50 <= delay <= 100 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_retry_max_is_at_least_retry_min():
+    assert scheduler.RetryPolicy(retry_min=120, retry_max=60).retry_max == 120
+
+
+def test_abandonment_counts_from_first_failure():
+    policy = scheduler.RetryPolicy(abandon_after=3600)
+    assert not policy.should_abandon(None, 10 ** 9)
+    assert not policy.should_abandon(1000, 1000 + 3599)
+    assert policy.should_abandon(1000, 1000 + 3600)
+
+
+def test_poll_interval_backs_off_while_idle():
+    poll = scheduler.PollScheduler(sleeptime=60, min_sleeptime=10, max_sleeptime=300)
+    assert poll.next_sleeptime(monitoring_cnt=2, reaped_cnt=0) == 10
+    assert poll.next_sleeptime(0, 1) == 60
+    assert [poll.next_sleeptime(0, 0) for _ in range(5)] == [60, 120, 240, 300, 300]
+    assert poll.next_sleeptime(1, 0) == 10
+    assert poll.next_sleeptime(0, 0) == 60
+
+
+def test_stability_needs_quiet_time_since_last_change():
+    stability = scheduler.StabilityTracker(quiet_time=30)
+    stability.changed('a', 100)
+    assert not stability.is_quiet('a', 129)
+    assert stability.is_quiet('a', 130)
+    stability.changed('a', 130)
+    assert not stability.is_quiet('a', 131)
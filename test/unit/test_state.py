@@ -0,0 +1,81 @@
+"""Tests of ReaperState indexes and its JSON and SQLite persistence"""
+
+# pylint: disable=missing-docstring,invalid-name
+
+import datetime
+
+from reaper import util
+from reaper import statedb
+from reaper.reaper import ReaperItem, ReaperState, to_epoch
+
+
+def make_state():
+    state = ReaperState()
+    state['reaped'] = ReaperItem({'images': 10, '_id': 'subj@group/project', 'opt': None}, reaped=True)
+    state['failing'] = ReaperItem({'images': 3, '_id': 'subj@group/project', 'opt': u'Research'}, failures=2,
+                                  first_failure=1500000000.5, retry_at=1500000600.0)
+    state['new'] = ReaperItem({'images': 1, '_id': u'p\xe4tient', 'opt': None}, path='/data/pfiles/P12345.7')
+    return state
+
+
+def assert_same_items(loaded, original):
+    assert sorted(loaded) == sorted(original)
+    for _id, item in original.iteritems():
+        assert loaded[_id].to_dict() == item.to_dict()
+    assert loaded.unreaped == set(['failing', 'new'])
+
+
+def test_json_round_trip(tmpdir):
+    path = str(tmpdir.join('state.json'))
+    state = make_state()
+    util.write_state_file(path, state)
+    assert_same_items(ReaperState(util.read_state_file(path)), state)
+
+
+def test_sqlite_round_trip(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    state = make_state()
+    statedb.StateDB(path).save(state)
+    assert_same_items(statedb.StateDB(path).load(ReaperState()), state)
+
+
+def test_sqlite_saves_changes_and_removals_incrementally(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    db = statedb.StateDB(path)
+    state = make_state()
+    db.save(state)
+    state['failing']['reaped'] = True
+    state.pop('new')
+    state['later'] = ReaperItem({'images': 5, '_id': 'x', 'opt': None})
+    assert (state.changed, state.removed) == (set(['failing', 'later']), set(['new']))
+    db.save(state)
+    assert (state.changed, state.removed) == (set(), set())
+    loaded = statedb.StateDB(path).load(ReaperState())
+    assert sorted(loaded) == ['failing', 'later', 'reaped']
+    assert loaded['failing']['reaped'] and loaded.unreaped == set(['later'])
+
+
+def test_unreaped_index_follows_items():
+    state = make_state()
+    assert state.unreaped == set(['failing', 'new'])
+    state['new']['reaped'] = True
+    state['reaped']['reaped'] = False
+    assert state.unreaped == set(['failing', 'reaped'])
+    state.pop('failing')
+    assert state.unreaped == set(['reaped'])
+    state['reaped'] = ReaperItem({'images': 1, '_id': 'x', 'opt': None}, reaped=True)  # replaced item
+    assert state.unreaped == set()
+
+
+def test_expired_follows_lastseen_and_replacement():
+    now = datetime.datetime(2017, 1, 2)
+    state = ReaperState()
+    for _id, hours in (('old', 30), ('older', 40), ('recent', 1)):
+        state[_id] = ReaperItem({'images': 1, '_id': 'x', 'opt': None}, lastseen=now - datetime.timedelta(hours=hours))
+    state['old']['lastseen'] = now  # seen again, its old heap entry is stale
+    state['older'] = ReaperItem({'images': 2, '_id': 'x', 'opt': None}, lastseen=now - datetime.timedelta(hours=40))
+    assert state.expired(now - datetime.timedelta(hours=24)) == ['older']
+    assert state.expired(now - datetime.timedelta(hours=24)) == []
+    state.pop('recent')
+    assert state.expired(now + datetime.timedelta(hours=1)) == ['old']
+    assert to_epoch(state['old']['lastseen']) == to_epoch(now)
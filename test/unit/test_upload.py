@@ -0,0 +1,42 @@
+"""Tests of the file:// upload backend"""
+
+# pylint: disable=missing-docstring,invalid-name
+
+import os
+import json
+
+from reaper import upload
+
+
+def metadata(session_label, acquisition_label):
+    return {
+        'group': {'_id': 'grp'},
+        'project': {'label': 'My Project'},
+        'session': {'label': session_label},
+        'acquisition': {'label': acquisition_label},
+    }
+
+
+def test_file_upload_delivers_archive_and_sidecar(tmpdir):
+    archive = tmpdir.join('a.dicom.zip')
+    archive.write('archive')
+    _, upload_function = upload.upload_function('file://' + str(tmpdir.join('sink')))
+    assert upload_function(str(archive), metadata('Session 1', 'T1w'))
+    target = tmpdir.join('sink', 'grp', 'My_Project', 'Session_1', 'T1w')
+    assert target.join('a.dicom.zip').read() == 'archive'
+    assert json.loads(target.join('a.dicom.zip' + upload.METADATA_SUFFIX).read())['acquisition']['label'] == 'T1w'
+    assert archive.check()  # the caller still owns the original
+    assert os.listdir(str(tmpdir.join('sink', upload.INCOMING_DIR))) == []
+
+
+def test_file_upload_with_non_ascii_labels(tmpdir):
+    archive = tmpdir.join('b.dicom.zip')
+    archive.write('archive')
+    _, upload_function = upload.upload_function('file://' + str(tmpdir.join('sink')))
+    assert upload_function(str(archive), metadata('M\xc3\xbcller', u'Kn\xf6chel'))
+    assert tmpdir.join('sink', 'grp', 'My_Project', 'M_ller', 'Kn_chel', 'b.dicom.zip').check()
+
+
+def test_tree_path_replaces_undecodable_bytes():
+    tree_path = getattr(upload, '__tree_path')
+    assert tree_path(metadata('M\xfcller', 'T2')) == ['grp', 'My_Project', 'M_ller', 'T2']